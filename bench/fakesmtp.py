@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of submit, a sendmail replacement or supplement for
+# multi-user desktop systems.
+#
+# Copyright © 2008 Michael Schutte <michi@uiae.at>
+#
+# submit is available under the terms of the MIT/X license.  Please see the
+# file COPYING for details.
+
+"""A fake SMTP server for benchmarks.
+
+Usage: bench/fakesmtp.py [PORT [LATENCY]]
+
+The server accepts every message and throws it away.  It announces
+PIPELINING, SIZE, 8BITMIME and CHUNKING, and STARTTLS or implicit TLS if it
+has been given an SSL context (which needs pyOpenSSL).  Before answering,
+it waits for LATENCY milliseconds, but only once for all commands that have
+arrived together, which is how a network round trip behaves.  When run as a
+script, it listens on PORT (default 2525) until interrupted."""
+
+from __future__ import with_statement
+import SocketServer
+import socket
+import sys
+import threading
+import time
+
+CRLF = "\r\n"
+
+class Reader:
+    """Reads lines and blocks of data from a socket (or an SSL connection)
+    and tells whether more data is already waiting in its buffer."""
+
+    def __init__(self, sock):
+        """Read from `sock`."""
+        self.sock = sock
+        self.buffer = ""
+
+    def fill(self):
+        """Receive more data; raise `EOFError` if the peer has gone."""
+        try:
+            data = self.sock.recv(65536)
+        except Exception:
+            data = ""
+        if not data:
+            raise EOFError
+        self.buffer += data
+
+    def readline(self):
+        """Return the next line including its line break."""
+        while "\n" not in self.buffer:
+            self.fill()
+        end = self.buffer.index("\n") + 1
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+    def read(self, size):
+        """Return the next `size` bytes."""
+        while len(self.buffer) < size:
+            self.fill()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def pending(self):
+        """Determine whether a complete line is already buffered."""
+        return "\n" in self.buffer
+
+class Handler(SocketServer.BaseRequestHandler):
+    """Talks to one SMTP client."""
+
+    def setup(self):
+        """Start TLS right away for implicit TLS (SMTPS)."""
+        self.sock = self.request
+        self.replies = []
+        self.tls = False
+        if self.server.implicit_tls:
+            self.start_tls()
+        self.reader = Reader(self.sock)
+
+    def start_tls(self):
+        """Wrap the connection in TLS."""
+        from OpenSSL import SSL
+        self.sock = SSL.Connection(self.server.context, self.sock)
+        self.sock.set_accept_state()
+        self.sock.do_handshake()
+        self.tls = True
+
+    def reply(self, line):
+        """Queue a reply.  Replies are sent as soon as the client has no
+        further commands in flight, after waiting for the latency; the lines
+        of a multiline reply are sent together."""
+        self.replies.append(line + CRLF)
+        if line[3:4] != "-" and not self.reader.pending():
+            self.flush()
+
+    def flush(self):
+        """Send the queued replies."""
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.sock.sendall("".join(self.replies))
+        self.replies = []
+
+    def handle(self):
+        """Run the SMTP dialogue."""
+        try:
+            self.reply("220 fakesmtp ESMTP")
+            while self.command(self.reader.readline()):
+                pass
+        except (EOFError, socket.error):
+            pass
+
+    def command(self, line):
+        """Handle one command line; return false at the end of the
+        session."""
+        cmd = line.strip()
+        verb = cmd.split(" ", 1)[0].upper()
+        if verb in ("EHLO", "HELO"):
+            features = ["PIPELINING", "SIZE 104857600", "8BITMIME",
+                    "CHUNKING", "AUTH PLAIN LOGIN"]
+            if self.server.context is not None and not self.tls:
+                features.append("STARTTLS")
+            self.reply("250-fakesmtp")
+            for feature in features[:-1]:
+                self.reply("250-" + feature)
+            self.reply("250 " + features[-1])
+        elif verb == "STARTTLS":
+            self.reply("220 go ahead")
+            self.start_tls()
+            self.reader = Reader(self.sock)
+        elif verb == "AUTH":
+            self.reply("235 ok")
+        elif verb in ("MAIL", "RCPT", "RSET", "NOOP"):
+            self.reply("250 ok")
+        elif verb == "DATA":
+            self.reply("354 go ahead")
+            while self.reader.readline() not in (".\r\n", ".\n"):
+                pass
+            self.server.count()
+            self.reply("250 queued")
+        elif verb == "BDAT":
+            args = cmd.split()
+            self.reader.read(int(args[1]))
+            if len(args) > 2 and args[2].upper() == "LAST":
+                self.server.count()
+            self.reply("250 ok")
+        elif verb == "QUIT":
+            self.reply("221 bye")
+            return False
+        else:
+            self.reply("500 unknown command")
+        return True
+
+class FakeSMTPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """The server, answering with a delay of `latency` seconds.  If an SSL
+    `context` is given, STARTTLS is offered, or TLS is started right away
+    if `implicit_tls` is true."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port = 0, latency = 0, context = None,
+            implicit_tls = False):
+        """Listen on `port` of the loopback interface (0 picks a free
+        one)."""
+        SocketServer.TCPServer.__init__(self, ("127.0.0.1", port), Handler)
+        self.latency = latency
+        self.context = context
+        self.implicit_tls = implicit_tls
+        self.messages = 0
+        self.lock = threading.Lock()
+
+    def count(self):
+        """Record a received message."""
+        with self.lock:
+            self.messages += 1
+
+    def start(self):
+        """Serve in a background thread and return the port."""
+        thd = threading.Thread(target=self.serve_forever)
+        thd.setDaemon(True)
+        thd.start()
+        return self.server_address[1]
+
+def make_context():
+    """Create a server-side SSL context with a fresh self-signed
+    certificate.  Raise `ImportError` if pyOpenSSL is missing."""
+    from OpenSSL import crypto, SSL
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = "localhost"
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, "sha256")
+    cx = SSL.Context(SSL.SSLv23_METHOD)
+    cx.use_privatekey(key)
+    cx.use_certificate(cert)
+    return cx
+
+def main():
+    port = 2525
+    latency = 0
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        latency = float(sys.argv[2]) / 1000
+    try:
+        context = make_context()
+    except ImportError:
+        context = None
+    server = FakeSMTPServer(port, latency, context)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print "%d messages received" % server.messages
+
+if __name__ == "__main__":
+    main()
+
+# vim:tw=78:fo-=t:sw=4:sts=4:et:
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of submit, a sendmail replacement or supplement for
+# multi-user desktop systems.
+#
+# Copyright © 2008 Michael Schutte <michi@uiae.at>
+#
+# submit is available under the terms of the MIT/X license.  Please see the
+# file COPYING for details.
+
+"""Measure how long it takes to start submit.
+
+Usage: bench/startup.py [RUNS]
+
+The submit script from this source tree is run RUNS times (default 20) for
+each scenario, and the minimum, median and maximum wall clock times are
+printed.  Afterwards, the modules with a noticeable load time that each
+scenario imports are listed.  Deliveries go to a sendmail stand-in which
+discards the message, so the numbers show the overhead of submit itself.
+The last scenario hands the message to a running daemon process."""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+SCRIPT = os.path.join(TOPDIR, "submit")
+
+# modules worth avoiding on the fast path
+HEAVY_MODULES = ("email", "OpenSSL", "gtk", "gnomekeyring", "submit.daemon",
+        "submit.message", "tempfile", "smtplib")
+
+MESSAGE = """\
+From: Sender <sender@example.com>
+To: Recipient <rcpt@example.com>
+Subject: startup benchmark
+
+Hello.
+"""
+
+CONFIG = """\
+[general]
+ui = tty
+
+[method local]
+type = sendmail
+program = sh -c 'cat >/dev/null'
+arguments =
+
+[method remote]
+type = sendmail
+program = sh -c 'cat >/dev/null'
+arguments =
+"""
+
+# run the submit script and report the heavy modules it has loaded
+PROBE = """\
+import atexit, sys
+def report():
+    names = [name for name in sys.modules if sys.modules[name] is not None
+            and name.split(".")[0] in HEAVY or name in HEAVY]
+    heavy = sorted(set([name for name in HEAVY if name in names]))
+    open(REPORT, "w").write(" ".join(heavy))
+atexit.register(report)
+sys.argv = ARGV
+execfile(sys.argv[0], {"__name__": "__main__"})
+"""
+
+def scenarios(confdir):
+    """Return (name, arguments, stdin, daemon) tuples.  If `daemon` is true,
+    the scenario needs the daemon process to be running."""
+    return [
+        ("--version", ["--version"], None, False),
+        ("sendmail delivery", ["-C", confdir, "rcpt@example.com"], MESSAGE,
+            False),
+        ("daemon delivery", ["-C", confdir, "rcpt@example.com"], MESSAGE,
+            True),
+    ]
+
+def run(args, stdin, env):
+    """Run the submit script once and return the elapsed time in seconds."""
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, SCRIPT] + args, env=env,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    proc.communicate(stdin or "")
+    elapsed = time.time() - start
+    if proc.returncode != 0:
+        raise RuntimeError("submit %s failed" % " ".join(args))
+    return elapsed
+
+def probe(args, stdin, env, report):
+    """Run the submit script once and return the heavy modules it loads."""
+    code = "HEAVY = %r\nREPORT = %r\nARGV = %r\n" % (HEAVY_MODULES, report,
+            [SCRIPT] + args) + PROBE
+    proc = subprocess.Popen([sys.executable, "-c", code], env=env,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    proc.communicate(stdin or "")
+    return open(report).read().split()
+
+def main():
+    runs = 20
+    if len(sys.argv) > 1:
+        runs = int(sys.argv[1])
+
+    tmpdir = tempfile.mkdtemp(prefix="submit-bench-")
+    daemon = False
+    try:
+        confdir = os.path.join(tmpdir, "conf")
+        os.mkdir(confdir)
+        open(os.path.join(confdir, "config"), "w").write(CONFIG)
+        env = dict(os.environ)
+        env["HOME"] = tmpdir
+        env["PYTHONPATH"] = os.path.join(TOPDIR, "lib")
+
+        baseline = []
+        for i in xrange(runs):
+            start = time.time()
+            subprocess.call([sys.executable, "-c", "pass"], env=env)
+            baseline.append(time.time() - start)
+        baseline.sort()
+        print "%-20s %8s %8s %8s" % ("scenario", "min", "median", "max")
+        print "%-20s %6.1fms %6.1fms %6.1fms" % ("python -c pass",
+                baseline[0] * 1000, baseline[runs // 2] * 1000,
+                baseline[-1] * 1000)
+
+        modules = []
+        for name, args, stdin, needs_daemon in scenarios(confdir):
+            if needs_daemon != daemon:
+                if needs_daemon:
+                    run(["-C", confdir, "--daemon"], None, env)
+                else:
+                    run(["-C", confdir, "--shutdown"], None, env)
+                daemon = needs_daemon
+            times = sorted([run(args, stdin, env) for i in xrange(runs)])
+            print "%-20s %6.1fms %6.1fms %6.1fms" % (name, times[0] * 1000,
+                    times[runs // 2] * 1000, times[-1] * 1000)
+            modules.append((name, probe(args, stdin, env,
+                os.path.join(tmpdir, "modules"))))
+
+        print
+        for name, loaded in modules:
+            print "%-20s %s" % (name, " ".join(loaded) or "-")
+    finally:
+        if daemon:
+            subprocess.call([sys.executable, SCRIPT, "-C", confdir,
+                "--shutdown"], env=env)
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
+
+# vim:tw=78:fo-=t:sw=4:sts=4:et:
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of submit, a sendmail replacement or supplement for
+# multi-user desktop systems.
+#
+# Copyright © 2008 Michael Schutte <michi@uiae.at>
+#
+# submit is available under the terms of the MIT/X license.  Please see the
+# file COPYING for details.
+
+"""Measure the throughput and latency of message submission.
+
+Usage: bench/throughput.py [OPTIONS]
+
+  -n COUNT        messages per scenario (default 40)
+  -c CLIENTS      submit processes running at the same time (default 4)
+  -l MS           latency of the fake SMTP server (default 0)
+  -t TYPES        delivery types, comma-separated (default
+                  sendmail,persistent,smtp,starttls,smtps)
+  -m MODES        direct and/or daemon (default both)
+  -s SIZES        message sizes, e.g. 1k,100k,2M (default 1k,100k,2M)
+  -r RCPTS        recipient counts (default 1,100)
+
+The submit script from this source tree is run as it would be by a mail
+client, once per message, and delivers to local stand-ins: the fake SMTP
+server from bench/fakesmtp.py (with STARTTLS or implicit TLS if pyOpenSSL
+is available) or a fake sendmail program which discards the message.  For
+each combination of delivery type, mode, message size and recipient count,
+the messages per second, the median and 99th percentile of the time a
+client takes, and the peak memory use of the clients and of the daemon
+process are printed.  Before that, the time it takes to start the daemon
+is shown; see bench/startup.py for the startup of the submit script
+itself."""
+
+from __future__ import with_statement
+import getopt
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+SCRIPT = os.path.join(TOPDIR, "submit")
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from fakesmtp import FakeSMTPServer, make_context
+
+SO_PEERCRED = 17    # Linux: (pid, uid, gid) of the peer of a UNIX socket
+
+# a sendmail stand-in: discard the message, or speak SMTP for `-bs`
+FAKE_SENDMAIL = """\
+import sys
+if "-bs" not in sys.argv:
+    while sys.stdin.read(65536): pass
+    sys.exit(0)
+def reply(line):
+    sys.stdout.write(line + "\\r\\n")
+    sys.stdout.flush()
+reply("220 fake sendmail")
+while True:
+    line = sys.stdin.readline()
+    verb = line.strip().split(" ", 1)[0].upper()
+    if not line or verb == "QUIT":
+        reply("221 bye")
+        break
+    elif verb == "EHLO":
+        reply("250-localhost")
+        reply("250 PIPELINING")
+    elif verb == "DATA":
+        reply("354 go ahead")
+        while sys.stdin.readline() not in (".\\r\\n", ".\\n", ""): pass
+        reply("250 queued")
+    else:
+        reply("250 ok")
+"""
+
+METHOD = {
+    "sendmail": "type = sendmail\nprogram = %(python)s %(sendmail)s\n",
+    "persistent": "type = sendmail\nprogram = %(python)s %(sendmail)s\n"
+            "persistent = yes\n",
+    "smtp": "type = smtp\nhost = 127.0.0.1:%(port)d\n",
+    "starttls": "type = smtp\nhost = 127.0.0.1:%(port)d\nstarttls = yes\n",
+    "smtps": "type = smtps\nhost = 127.0.0.1:%(port)d\n",
+}
+
+def parse_size(size):
+    """Convert a size like `100k` or `2M` into bytes."""
+    factor = {"k": 1024, "m": 1024 ** 2}.get(size[-1:].lower())
+    if factor:
+        return int(size[:-1]) * factor
+    return int(size)
+
+def make_message(size, rcpts):
+    """Return a message of about `size` bytes to `rcpts` recipients, and
+    the recipient addresses."""
+    addresses = ["rcpt%d@example.com" % i for i in xrange(rcpts)]
+    header = "From: Sender <sender@example.com>\nTo: %s\n" \
+            "Subject: throughput benchmark\n\n" % addresses[0]
+    line = "x" * 71 + "\n"
+    body = line * max((size - len(header)) // len(line), 1)
+    return header + body, addresses
+
+def write_config(confdir, tpe, mode, values):
+    """Write the configuration for delivery type `tpe` to `confdir`."""
+    if not os.path.isdir(confdir):
+        os.mkdir(confdir)
+    config = "[general]\nui = tty\n"
+    if mode == "daemon":
+        config += "force_daemon = yes\n"
+    config += "\n[method remote]\n" + METHOD[tpe] % values
+    open(os.path.join(confdir, "config"), "w").write(config)
+
+def submit(args, stdin, env):
+    """Run the submit script once.  Return the elapsed time in seconds and
+    its peak resident set size in kilobytes."""
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, SCRIPT] + args, env=env,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    proc.stdin.write(stdin or "")
+    proc.stdin.close()
+    pid, status, usage = os.wait4(proc.pid, 0)
+    elapsed = time.time() - start
+    proc.returncode = status
+    if status != 0:
+        raise RuntimeError("submit %s failed" % " ".join(args[:3]))
+    return elapsed, usage.ru_maxrss
+
+def daemon_rss(confdir):
+    """Return the peak resident set size of the daemon process listening
+    on the socket in `confdir`, in kilobytes, or `None` if it cannot be
+    determined (this works on Linux only)."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(os.path.join(confdir, "socket"))
+        creds = sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                struct.calcsize("3i"))
+        pid = struct.unpack("3i", creds)[0]
+        for line in open("/proc/%d/status" % pid):
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    except (socket.error, IOError):
+        return None
+    finally:
+        sock.close()
+    return None
+
+def percentile(values, fraction):
+    """Return the given `fraction` percentile of the sorted `values`."""
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def run_scenario(confdir, count, clients, message, rcpts, env):
+    """Submit `count` messages using `clients` processes at once.  Return
+    the total time, the sorted latencies and the peak client RSS."""
+    args = ["-C", confdir] + rcpts
+    latencies = []
+    peak = [0]
+    errors = []
+    remaining = [count]
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                if remaining[0] <= 0: return
+                remaining[0] -= 1
+            try:
+                elapsed, rss = submit(args, message, env)
+            except RuntimeError, e:
+                errors.append(e)
+                return
+            with lock:
+                latencies.append(elapsed)
+                peak[0] = max(peak[0], rss)
+
+    start = time.time()
+    threads = [threading.Thread(target=client) for i in xrange(clients)]
+    for thd in threads:
+        thd.start()
+    for thd in threads:
+        thd.join()
+    total = time.time() - start
+    if errors:
+        raise errors[0]
+    return total, sorted(latencies), peak[0]
+
+def main():
+    count = 40
+    clients = 4
+    latency = 0
+    types = ["sendmail", "persistent", "smtp", "starttls", "smtps"]
+    modes = ["direct", "daemon"]
+    sizes = ["1k", "100k", "2M"]
+    rcpt_counts = [1, 100]
+    opts, args = getopt.getopt(sys.argv[1:], "n:c:l:t:m:s:r:")
+    for opt, arg in opts:
+        if opt == "-n": count = int(arg)
+        elif opt == "-c": clients = int(arg)
+        elif opt == "-l": latency = float(arg) / 1000
+        elif opt == "-t": types = arg.split(",")
+        elif opt == "-m": modes = arg.split(",")
+        elif opt == "-s": sizes = arg.split(",")
+        elif opt == "-r": rcpt_counts = [int(n) for n in arg.split(",")]
+
+    try:
+        context = make_context()
+    except ImportError:
+        context = None
+        skipped = [tpe for tpe in types if tpe in ("starttls", "smtps")]
+        if skipped:
+            print "pyOpenSSL is not available; skipping %s" % \
+                    ", ".join(skipped)
+            print
+        types = [tpe for tpe in types if tpe not in skipped]
+    servers = {
+        "smtp": FakeSMTPServer(0, latency),
+        "starttls": FakeSMTPServer(0, latency, context),
+        "smtps": FakeSMTPServer(0, latency, context, True),
+    }
+    ports = {}
+    for tpe in types:
+        if tpe in servers:
+            ports[tpe] = servers[tpe].start()
+
+    tmpdir = tempfile.mkdtemp(prefix="submit-bench-")
+    running = []    # configuration directories with a daemon process
+    try:
+        env = dict(os.environ)
+        env["HOME"] = tmpdir
+        env["PYTHONPATH"] = os.path.join(TOPDIR, "lib")
+        # mail clients do not run submit unbuffered, which would make
+        # reading the message from stdin many times slower
+        env.pop("PYTHONUNBUFFERED", None)
+        sendmail = os.path.join(tmpdir, "sendmail.py")
+        open(sendmail, "w").write(FAKE_SENDMAIL)
+
+        confdir = os.path.join(tmpdir, "startup")
+        write_config(confdir, "sendmail", "daemon",
+                dict(python=sys.executable, sendmail=sendmail))
+        times = []
+        for i in xrange(5):
+            start = time.time()
+            submit(["-C", confdir, "--daemon"], None, env)
+            times.append(time.time() - start)
+            submit(["-C", confdir, "--shutdown"], None, env)
+        times.sort()
+        print "daemon startup: %.1fms (median of %d)" % (
+                times[len(times) // 2] * 1000, len(times))
+        print
+
+        print "%-30s %8s %8s %8s %10s %10s" % ("scenario", "msgs/s",
+                "p50", "p99", "client RSS", "daemon RSS")
+        for tpe in types:
+            for mode in modes:
+                confdir = os.path.join(tmpdir, "%s-%s" % (tpe, mode))
+                write_config(confdir, tpe, mode, dict(python=sys.executable,
+                    sendmail=sendmail, port=ports.get(tpe, 0)))
+                if mode == "daemon":
+                    submit(["-C", confdir, "--daemon"], None, env)
+                    running.append(confdir)
+                for size in sizes:
+                    for rcpts in rcpt_counts:
+                        message, addresses = make_message(parse_size(size),
+                                rcpts)
+                        total, latencies, rss = run_scenario(confdir, count,
+                                clients, message, addresses, env)
+                        drss = None
+                        if mode == "daemon":
+                            drss = daemon_rss(confdir)
+                        name = "%s %s %s %drcpt" % (tpe, mode, size, rcpts)
+                        print "%-30s %8.1f %6.1fms %6.1fms %8dkB %10s" % (
+                                name, count / total,
+                                percentile(latencies, 0.5) * 1000,
+                                percentile(latencies, 0.99) * 1000, rss,
+                                drss is None and "-" or "%dkB" % drss)
+                        sys.stdout.flush()
+                if mode == "daemon":
+                    submit(["-C", confdir, "--shutdown"], None, env)
+                    running.remove(confdir)
+    finally:
+        for confdir in running:
+            subprocess.call([sys.executable, SCRIPT, "-C", confdir,
+                "--shutdown"], env=env)
+        shutil.rmtree(tmpdir)
+        for tpe in ports:
+            servers[tpe].shutdown()
+            servers[tpe].server_close()
+
+    for tpe in sorted(ports):
+        print "%s server: %d messages received" % (tpe,
+                servers[tpe].messages)
+
+if __name__ == "__main__":
+    main()
+
+# vim:tw=78:fo-=t:sw=4:sts=4:et:
@@ -16,7 +16,8 @@ from contextlib import *
 import threading
 import time
 
-__all__ = ["PasswordStore", "AbstractAuthenticator", "UnlockRequest",
+__all__ = ["PasswordStore", "AbstractAuthenticator",
+        "FrontendAuthenticator", "UnlockRequest",
         "PasswordRequest", "PasswordResponse",
         "AuthenticationCancelledResponse"]
 
@@ -32,15 +33,18 @@ class PasswordStore:
         self.passwords = {}
         self.lock = threading.Lock()
         self.last_access = None
+        self.generation = 0     # incremented whenever the store is cleared
 
     def expire(self, timeout):
         """If the last access to the password store was more than `timeout`
-        seconds ago, purge the stored data."""
-        if self.last_access is None: return
+        seconds ago, purge the stored data and return true."""
+        if self.last_access is None: return False
         now = time.time()
         if (now < self.last_access) or (now - self.last_access > timeout):
             with self:
                 self.clear()
+            return True
+        return False
 
     def __enter__(self):
         """Acquire the lock.
@@ -54,8 +58,11 @@ class PasswordStore:
         self.last_access = time.time()
 
     def clear(self):
-        """Remove all stored passwords."""
+        """Remove all stored passwords.  Anything derived from them (such
+        as a decrypted private key) should be dropped as well, which is why
+        `generation` is incremented."""
         self.passwords.clear()
+        self.generation += 1
 
     def get(self, config, key, default = None):
         """Obtain the password `key` from the cache or from the configuration
@@ -128,6 +135,19 @@ class AbstractAuthenticator:
         their credentials."""
         raise NotImplementedError, "abstract query_password() called"
 
+class FrontendAuthenticator(AbstractAuthenticator):
+    """An authenticator used as a daemonless provider of credentials.  It
+    directly passes on password requests to the frontend."""
+
+    def __init__(self, store, frontend):
+        """Create a new frontend authenticator."""
+        AbstractAuthenticator.__init__(self, store)
+        self.frontend = frontend
+
+    def query_password(self, key, query, first):
+        """Ask the user for a password."""
+        return self.frontend.ask_password(self.store.method, key, query, first)
+
 class UnlockRequest:
     """Ask for one or all delivery methods to be unlocked.  This simply means
     that an authentication process is started with the requested method(s),
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of submit, a sendmail replacement or supplement for
+# multi-user desktop systems.
+#
+# Copyright © 2008 Michael Schutte <michi@uiae.at>
+#
+# submit is available under the terms of the MIT/X license.  Please see the
+# file COPYING for details.
+
+from submit.body import *
+import os
+import re
+import sys
+
+__all__ = ["read_batch"]
+
+# mboxrd quoting: “>From ” with one or more “>” is unquoted by one level
+FROM_QUOTED_RE = re.compile(r"^>+From ")
+
+def read_batch(path):
+    """Iterate over the messages submitted with `--batch path`, returning
+    (header, body) tuples as `spool_message` does.  `path` can be an mbox
+    file, a directory containing one message per file, or “-” for a stream
+    of messages on stdin, each preceded by a line containing its length in
+    bytes."""
+    if path == "-":
+        return read_stream(sys.stdin)
+    elif os.path.isdir(path):
+        return read_directory(path)
+    else:
+        return read_mbox(open(path, "rb"))
+
+def read_stream(fin):
+    """Iterate over the length-prefixed messages in the file `fin`.  A
+    `ValueError` is raised if a length is malformed."""
+    while True:
+        line = fin.readline()
+        if line == "": return
+        if not line.strip(): continue
+        length = int(line)
+        if length < 0:
+            raise ValueError, "negative message length"
+        yield spool_lines(read_limited(fin, length))
+
+def read_limited(fin, length):
+    """Iterate over the lines in the next `length` bytes of `fin`."""
+    while length > 0:
+        line = fin.readline(length)
+        if line == "":
+            raise ValueError, "unexpected end of batch"
+        length -= len(line)
+        yield line
+
+def read_directory(path):
+    """Iterate over the messages in the files of the directory `path`, in
+    the order of their names.  Hidden files are skipped."""
+    for filename in sorted(os.listdir(path)):
+        filename = os.path.join(path, filename)
+        if os.path.basename(filename).startswith(".") or \
+                not os.path.isfile(filename):
+            continue
+        fin = open(filename, "rb")
+        try:
+            yield spool_message(fin, False)
+        finally:
+            fin.close()
+
+def read_mbox(fin):
+    """Iterate over the messages in the mbox file `fin`.  Messages start
+    with a “From ” line at the beginning of the file or after an empty line;
+    that empty line is not part of the previous message."""
+    separator = [fin.readline()]
+
+    def lines():
+        blank = None
+        while True:
+            line = fin.readline()
+            if line == "" or (blank is not None and line.startswith("From ")):
+                separator[0] = line
+                return
+            if blank is not None:
+                yield blank
+                blank = None
+            if line in ("\n", "\r\n"):
+                blank = line
+                continue
+            if FROM_QUOTED_RE.match(line):
+                line = line[1:]
+            yield line
+
+    while separator[0]:
+        if separator[0].startswith("From "):
+            yield spool_lines(lines())
+        else:
+            # not an mbox separator; skip anything before the first message
+            separator[0] = fin.readline()
+
+# vim:tw=78:fo-=t:sw=4:sts=4:et:
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of submit, a sendmail replacement or supplement for
+# multi-user desktop systems.
+#
+# Copyright © 2008 Michael Schutte <michi@uiae.at>
+#
+# submit is available under the terms of the MIT/X license.  Please see the
+# file COPYING for details.
+
+from __future__ import with_statement
+import os
+import re
+import tempfile
+import threading
+
+__all__ = ["MessageBody", "spool_message", "spool_lines"]
+
+SPOOL_SIZE = 1024 * 1024    # bodies larger than this go to a temporary file
+CHUNK_SIZE = 64 * 1024      # amount of data read or written at once
+
+# lines which can be part of a message header (cf. email.feedparser)
+HEADER_RE = re.compile(r"^(From |[\041-\071\073-\176]+:|[\t ])")
+
+class MessageBody:
+    """The body of a message, i.e., everything after the header and the
+    empty line following it.  The data is kept in memory as long as it is
+    small and spooled to a temporary file otherwise.  Reads are positional,
+    so several deliverers can stream the same body at once."""
+
+    def __init__(self, data = None, fileobj = None):
+        """Create a new body, optionally initialized with the string `data`.
+        If an open file `fileobj` is given, its contents are used as the
+        body instead of a new spool."""
+        if fileobj is None:
+            self.file = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+            self.size = 0
+        else:
+            self.file = fileobj
+            self.size = os.fstat(fileobj.fileno()).st_size
+        self.lock = threading.Lock()
+        if data:
+            self.write(data)
+
+    def in_file(self):
+        """Determine whether the body has been spooled to a temporary
+        file."""
+        return self.size > SPOOL_SIZE
+
+    def fileno(self):
+        """Return the file descriptor of the (unlinked) temporary file
+        holding the body, moving the body there if necessary."""
+        with self.lock:
+            fd = self.file.fileno()
+            self.file.flush()
+            return fd
+
+    def write(self, data):
+        """Append `data` to the body."""
+        with self.lock:
+            self.file.seek(0, 2)
+            self.file.write(data)
+            self.size += len(data)
+
+    def read_at(self, offset, size):
+        """Read up to `size` bytes starting at `offset`."""
+        with self.lock:
+            self.file.seek(offset)
+            return self.file.read(size)
+
+    def chunks(self, size = CHUNK_SIZE):
+        """Iterate over the body in strings of at most `size` bytes."""
+        offset = 0
+        while True:
+            data = self.read_at(offset, size)
+            if not data: break
+            offset += len(data)
+            yield data
+
+    def lines(self):
+        """Iterate over the lines of the body.  Line terminators are kept;
+        the last line may lack one."""
+        rest = ""
+        for chunk in self.chunks():
+            data = rest + chunk
+            start = 0
+            while True:
+                end = data.find("\n", start)
+                if end == -1: break
+                yield data[start:end + 1]
+                start = end + 1
+            rest = data[start:]
+        if rest:
+            yield rest
+
+    def getvalue(self):
+        """Return the whole body as a string."""
+        return "".join(self.chunks())
+
+    def __getstate__(self):
+        """Pickle the body as a plain string."""
+        return self.getvalue()
+
+    def __setstate__(self, data):
+        """Restore a pickled body."""
+        self.__init__(data)
+
+def spool_message(fin, period_eof = True):
+    """Read a message from the file `fin` and split it into its header and
+    its body.  The header is returned as a string; the body (which is only
+    read line by line) as a `MessageBody`.  If `period_eof` is true, a line
+    containing only a period ends the message.
+
+    A leading “From ” line is dropped.  The empty line separating header and
+    body is not part of either."""
+    return spool_lines(iter(fin.readline, ""), period_eof)
+
+def spool_lines(lines, period_eof = False):
+    """Like `spool_message`, but read the message from an iterable of
+    `lines`."""
+    header = []
+    body = None
+    first = True
+    for line in lines:
+        if period_eof and line.rstrip("\r\n") == ".": break
+        if body is not None:
+            body.write(line)
+            continue
+        match = HEADER_RE.match(line)
+        if first and line.startswith("From "):
+            pass
+        elif match and not match.group(1).startswith("From "):
+            header.append(line)
+        else:
+            body = MessageBody()
+            if line.rstrip("\r\n"):
+                # no empty line after the header; keep this one
+                body.write(line)
+        first = False
+    if body is None:
+        body = MessageBody()
+    return "".join(header), body
+
+# vim:tw=78:fo-=t:sw=4:sts=4:et:
@@ -11,48 +11,76 @@
 from submit.errors import *
 import os
 import socket
-import pickle
+import cPickle as pickle
 import struct
 
-__all__ = ["Channel", "ChannelError", "ConfigRequest", "MessageRequest",
-        "CloseRequest", "ShutdownRequest", "DeliverySuccessMessage",
-        "InternalError"]
+__all__ = ["Channel", "ChannelError", "ConfigRequest", "ConfigLocation",
+        "MessageRequest", "QueueStatus", "RawMessage", "CloseRequest",
+        "ShutdownRequest", "DeliverySuccessMessage", "InternalError"]
 
-LENGTH_FORMAT = "!L"        # transfer chunk length as C unsigned long
-LENGTH_SIZE = struct.calcsize(LENGTH_FORMAT)    # sizeof(unsigned long)
-LONG_MAX = 256 ** LENGTH_SIZE - 1               # LONG_MAX
+CHUNK_SIZE = 64 * 1024      # size of the receive buffer for payloads
+FRAME_FORMAT = "!BL"        # frame type, length as C unsigned long
+FRAME_SIZE = struct.calcsize(FRAME_FORMAT)
+LONG_MAX = 256 ** struct.calcsize("!L") - 1     # LONG_MAX
+DEFAULT_BACKLOG = 128       # connections waiting to be accepted
+
+FRAME_OBJECT = 1            # a pickled object
+FRAME_OBJECT_PAYLOAD = 2    # a pickled object followed by a payload
+FRAME_PAYLOAD = 3           # a piece of payload; an empty one ends it
+FRAME_DESCRIPTOR = 4        # payload is in a file opened by the sender
+FRAME_ACK = 5               # answer to FRAME_DESCRIPTOR
+
+DESCRIPTOR_FORMAT = "!LL"   # process ID, file descriptor
+ACK_FORMAT = "!B"           # 1 if the file could be opened, 0 otherwise
 
 class ChannelError(Exception):
     """Something went wrong in the communication process."""
 
 class Channel:
     """submit frontends and the daemon process communicate over a socket in
-    the UNIX domain.  They do so by sending and receiving pickled objects.
-    This class wraps a socket and represents an endpoint of a communication
-    channel."""
+    the UNIX domain.  They do so by sending and receiving pickled objects,
+    which can be followed by a raw payload (such as the body of a message)
+    that is transferred without pickling.  This class wraps a socket and
+    represents an endpoint of a communication channel.
+
+    Every transmission is a frame consisting of a type, a length and that
+    many bytes of data."""
 
     def __init__(self, socket):
         """Set up this channel endpoint."""
         self.socket = socket
+        self.buffer = bytearray(CHUNK_SIZE)
+        self.accept_files = True
 
     @classmethod
     def get_path(cls, config):
         """Determine the path to the UNIX domain socket, which is specified by
-        the configuration key `general.socket` (default
-        `~/.submit/socket`)."""
-        return config.get_general(str, "socket",
-                os.path.expanduser("~/.submit/socket"))
+        the configuration key `general.socket` (default `socket` in the
+        configuration directory)."""
+        return config.path(config.get_general(str, "socket", "socket"))
+
+    @classmethod
+    def get_default_path(cls, confdir = None):
+        """Determine the path to the socket for the configuration directory
+        `confdir` (default `~/.submit`), assuming that `general.socket` is
+        not set.  Unlike `get_path`, this does not need the configuration to
+        be loaded."""
+        if not confdir:
+            confdir = os.path.expanduser("~/.submit")
+        return os.path.join(confdir, "socket")
 
     @classmethod
     def setup(cls, config, filename = None):
-        """Create the socket."""
+        """Create the socket.  Up to `general.backlog` connections can wait
+        for the daemon to accept them."""
         if filename is None:
             filename = cls.get_path(config)
         if os.path.exists(filename):
             os.remove(filename)
         srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         srv.bind(filename)
-        srv.listen(1)
+        srv.listen(max(config.get_general(int, "backlog", DEFAULT_BACKLOG),
+            1))
         return srv
 
     @classmethod
@@ -62,7 +90,11 @@ class Channel:
 
         A `ChannelError` will be raised if there is no channel yet, which
         in most cases means that the daemon has not been started yet."""
-        filename = cls.get_path(config)
+        return cls.connect_path(cls.get_path(config))
+
+    @classmethod
+    def connect_path(cls, filename):
+        """Like `connect`, but use the socket `filename`."""
         if not os.path.exists(filename):
             raise ChannelError, "channel does not exist"
         sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
@@ -74,50 +106,195 @@ class Channel:
                 raise e
         return cls(sock)
 
-    def receive(self):
-        """Receive a pickled object and return a `load`ed instance."""
-        s = ""
-        while True:
+    def fileno(self):
+        """Return the file descriptor of the socket, so that channels can be
+        passed to `select`."""
+        return self.socket.fileno()
+
+    def receive_exactly(self, view):
+        """Fill the memoryview `view` with data from the socket, however many
+        calls to `recv_into` it takes."""
+        while len(view) > 0:
             try:
-                length = self.socket.recv(LENGTH_SIZE)
-                if not length:
-                    raise EOFError
+                received = self.socket.recv_into(view)
             except socket.error:
                 raise EOFError
+            if received == 0:
+                raise EOFError
+            view = view[received:]
 
-            length = struct.unpack(LENGTH_FORMAT, length)[0]
-            if length == 0:
-                break
-            s += self.socket.recv(length)
+    def receive_frame_header(self):
+        """Receive the header of the next frame and return (type, length)."""
+        header = bytearray(FRAME_SIZE)
+        self.receive_exactly(memoryview(header))
+        return struct.unpack(FRAME_FORMAT, str(header))
 
-        return pickle.loads(s)
+    def receive(self):
+        """Receive a pickled object and return a `load`ed instance.  If the
+        object is followed by a payload, it is read into a `MessageBody`
+        and passed to the object’s `attach_payload` method."""
+        kind, length = self.receive_frame_header()
+        if kind not in (FRAME_OBJECT, FRAME_OBJECT_PAYLOAD):
+            raise ChannelError, "unexpected frame type %d" % kind
+        obj = pickle.loads(self.receive_data(length))
+        if kind == FRAME_OBJECT_PAYLOAD:
+            obj.attach_payload(self.receive_payload())
+        return obj
+
+    def receive_data(self, length):
+        """Receive `length` bytes and return them as a string."""
+        data = bytearray(length)
+        self.receive_exactly(memoryview(data))
+        return str(data)
 
-    def send(self, msg):
-        """Send a `msg` to the peer, pickle-`dump`ing it before
-        transmission."""
-        smsg = pickle.dumps(msg)
+    def receive_payload(self):
+        """Receive payload frames up to the terminating empty one and return
+        their contents as a `MessageBody`.  If the peer offers the file
+        holding the payload instead, try to open it (unless `accept_files`
+        has been set to false); only if that fails, the payload frames
+        follow."""
+        from submit.body import MessageBody
+        payload = MessageBody()
+        view = memoryview(self.buffer)
         while True:
-            s = smsg[:LONG_MAX]
-            length = len(s)
-            self.socket.sendall(struct.pack(LENGTH_FORMAT, length))
-            if length != 0: self.socket.sendall(s)
-            else: break
-            smsg = smsg[length:]
+            kind, length = self.receive_frame_header()
+            if kind == FRAME_DESCRIPTOR:
+                pid, fd = struct.unpack(DESCRIPTOR_FORMAT,
+                        self.receive_data(length))
+                opened = None
+                if self.accept_files:
+                    opened = open_descriptor(pid, fd)
+                self.send_frame(FRAME_ACK,
+                        struct.pack(ACK_FORMAT, opened is not None))
+                if opened is not None:
+                    return MessageBody(fileobj=opened)
+                continue
+            elif kind != FRAME_PAYLOAD:
+                raise ChannelError, "unexpected frame type %d" % kind
+            if length == 0:
+                return payload
+            while length > 0:
+                piece = view[:min(length, len(view))]
+                self.receive_exactly(piece)
+                payload.write(piece)
+                length -= len(piece)
+
+    def send_frame(self, kind, data):
+        """Send a single frame containing the string `data`."""
+        self.socket.sendall(struct.pack(FRAME_FORMAT, kind, len(data)) + data)
+
+    def send(self, msg, payload = None, pass_file = False):
+        """Send a `msg` to the peer, pickle-`dump`ing it before transmission.
+        If a `payload` (an object with a `chunks` method, such as a
+        `MessageBody`) is given, its contents are sent as they are after the
+        pickled object.
+
+        If `pass_file` is true, the payload must also have a `fileno`
+        method.  The peer is then asked to open that file by itself, which
+        saves copying the payload through the socket."""
+        smsg = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+        if len(smsg) > LONG_MAX:
+            raise ChannelError, "object too large"
+        if payload is None:
+            kind = FRAME_OBJECT
+        else:
+            kind = FRAME_OBJECT_PAYLOAD
+        self.send_frame(kind, smsg)
+        if payload is not None:
+            if pass_file and self.pass_descriptor(payload.fileno()):
+                return
+            for chunk in payload.chunks():
+                self.socket.sendall(
+                        struct.pack(FRAME_FORMAT, FRAME_PAYLOAD, len(chunk)))
+                self.socket.sendall(chunk)
+            self.socket.sendall(struct.pack(FRAME_FORMAT, FRAME_PAYLOAD, 0))
+
+    def pass_descriptor(self, fd):
+        """Offer the open file descriptor `fd` to the peer and return true
+        if the peer was able to open the file."""
+        self.send_frame(FRAME_DESCRIPTOR,
+                struct.pack(DESCRIPTOR_FORMAT, os.getpid(), fd))
+        kind, length = self.receive_frame_header()
+        if kind != FRAME_ACK:
+            raise ChannelError, "unexpected frame type %d" % kind
+        return struct.unpack(ACK_FORMAT, self.receive_data(length))[0] != 0
 
     def close(self):
         """Close the underlying socket."""
         self.socket.close()
 
+def open_descriptor(pid, fd):
+    """Open the file behind the descriptor `fd` of process `pid` for reading,
+    which works even if the file has already been unlinked.  This relies on
+    the /proc file system as found on Linux; if the file cannot be opened,
+    return `None`."""
+    try:
+        return open("/proc/%d/fd/%d" % (pid, fd), "rb")
+    except (IOError, OSError):
+        return None
+
 class ConfigRequest:
-    """Demand a `Config` object and announce the version number of the daemon
+    """Demand a `ConfigLocation` and announce the version number of the daemon
     process."""
 
     def __init__(self, version):
         self.version = version
 
+class ConfigLocation:
+    """Answer to a `ConfigRequest`: tell the daemon which configuration to
+    use.  Only the location is transferred; the daemon loads and caches the
+    configuration itself."""
+
+    def __init__(self, confdir):
+        """Refer to the configuration in `confdir` (an absolute path, or
+        `None` for the default location)."""
+        self.confdir = confdir
+
 class MessageRequest:
     """Demand transfer of the message to be submitted."""
 
+class QueueStatus:
+    """Tell a client that the daemon is busy and that its request will be
+    handled once the clients ahead of it are done."""
+
+    def __init__(self, depth):
+        """Report that `depth` clients are ahead of this one."""
+        self.depth = depth
+
+class RawMessage:
+    """Answer to a `MessageRequest` from a frontend which leaves parsing the
+    message to the daemon.  It contains the unparsed header and the
+    envelope as given on the command line; the body follows as the
+    payload.  `read_time` is the number of seconds the frontend has spent
+    reading the message, or `None`."""
+
+    def __init__(self, header, body, rcpts, parse_rcpts = False,
+            efrom = None, read_time = None):
+        """Wrap a message as returned by `spool_message`.  The remaining
+        arguments are those of `Message`."""
+        self.header = header
+        self.body = body
+        self.rcpts = rcpts
+        self.parse_rcpts = parse_rcpts
+        self.efrom = efrom
+        self.read_time = read_time
+
+    def __getstate__(self):
+        """Pickle everything but the body."""
+        state = self.__dict__.copy()
+        del state["body"]
+        return state
+
+    def attach_payload(self, body):
+        """Set the body of a message received over a `Channel`."""
+        self.body = body
+
+    def parse(self, config):
+        """Parse the header and return the resulting `Message`."""
+        from submit.message import Message
+        return Message(config, self.header, self.body, self.rcpts,
+                self.parse_rcpts, self.efrom)
+
 class CloseRequest:
     """Close the connection."""
 
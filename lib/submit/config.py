@@ -9,24 +9,31 @@
 # file COPYING for details.
 
 from __future__ import with_statement
+from submit.routing import *
 from ConfigParser import SafeConfigParser
 import os
 import socket
+import threading
 
-__all__ = ["Config"]
+__all__ = ["Config", "ConfigCache"]
 
 DEFAULT_CONFIG_PATH = os.path.expanduser("~/.submit")
 
 class Config:
     """The configuration store.  Configuration files are looked for in
     /etc/submit/config and ~/.submit/config (if no other file name was
-    specified by the user)."""
+    specified by the user).
+
+    A `Config` is never changed after it has been loaded, so typed values
+    are converted only once and then served from a cache."""
 
     def __init__(self, confdir = None):
         """Load a configuration file.  If an explicit `confdir` is given, the
         `config` file in there is read.  Otherwise, ~/.submit/config is
         tried; if it doesn’t exist, no configuration is loaded at all."""
         self.config = SafeConfigParser()
+        self.values = {}
+        self.routing_table = None
         if confdir:
             self.confdir = confdir
             self.load_config(os.path.join(confdir, "config"))
@@ -49,16 +56,49 @@ class Config:
         """Return the name of all sections starting with `method `."""
         return [i[7:] for i in self.config.sections() if i.startswith("method ")]
 
+    def get_routing_table(self):
+        """Return the `RoutingTable` compiled from the delivery methods of
+        this configuration.  It is compiled on first use only."""
+        if self.routing_table is None:
+            self.routing_table = RoutingTable(self)
+        return self.routing_table
+
     def get_method(self, tpe, section, name, default = None):
         """Retrieve a value from the given delivery method `section`, for
         example, `local` or `remote`.  See `get`."""
         return self.get(tpe, "method " + section, name, default)
 
+    def get_method_items(self, section):
+        """Return all raw (name, value) pairs of the given delivery method
+        `section` as a sorted tuple, which is useful to check whether two
+        configurations agree on a method."""
+        section = "method " + section
+        if not self.config.has_section(section):
+            return ()
+        return tuple(sorted(self.config.items(section, True)))
+
     def get(self, tpe, section, name, default = None):
         """Retrieve a value from the given `section`, typed `tpe`
         (`string`, `int`, `float` or `boolean`).  If there is no matching key,
         return `default`; if that is a function, return its result when called
         without parameters."""
+        key = (tpe, section, name)
+        try:
+            value = self.values[key]
+        except KeyError:
+            value = self.values[key] = self.convert(tpe, section, name)
+
+        if value is None:
+            if callable(default):
+                value = default()
+            else:
+                value = default
+
+        return value
+
+    def convert(self, tpe, section, name):
+        """Retrieve a value from the configuration file and convert it to the
+        type `tpe` (see `get`).  Return `None` if there is no such value."""
         value = None
         if not self.config.has_option(section, name):
             pass
@@ -71,13 +111,6 @@ class Config:
             except ValueError: pass
         else:
             value = self.config.get(section, name)
-
-        if value is None:
-            if callable(default):
-                value = default()
-            else:
-                value = default
-
         return value
 
     def path(self, filename):
@@ -107,4 +140,46 @@ class Config:
         mod = getattr(getattr(mod, "deliverers"), modname)
         return mod.Deliverer(self, method)
 
+    def create_deliverers(self, routes):
+        """Create (deliverer, recipients) pairs for the given (method,
+        recipients) `routes`.  If a deliverer wants to spread its recipients
+        over several connections (see `AbstractDeliverer.fan_out`), there is
+        one pair for each of them."""
+        result = []
+        for method, rcpts in routes:
+            deliverer = self.create_deliverer(method)
+            groups = deliverer.fan_out(rcpts)
+            result.append((deliverer, groups[0]))
+            for group in groups[1:]:
+                result.append((self.create_deliverer(method), group))
+        return result
+
+class ConfigCache:
+    """The configurations used by the daemon process, kept in memory and
+    keyed by their directory.  A configuration is only loaded again when its
+    file has changed."""
+
+    def __init__(self):
+        """Create an empty cache."""
+        self.configs = {}   # confdir: (file status, Config)
+        self.lock = threading.Lock()
+
+    def get(self, confdir = None):
+        """Return the `Config` for `confdir` (see `Config.__init__`),
+        loading it if it is not cached or out of date."""
+        filename = os.path.join(confdir or DEFAULT_CONFIG_PATH, "config")
+        try:
+            st = os.stat(filename)
+            status = (st.st_ino, st.st_size, st.st_mtime)
+        except OSError:
+            status = None
+        with self.lock:
+            cached = self.configs.get(confdir)
+        if cached is not None and cached[0] == status:
+            return cached[1]
+        config = Config(confdir)
+        with self.lock:
+            self.configs[confdir] = (status, config)
+        return config
+
 # vim:tw=78:fo-=t:sw=4:sts=4:et:
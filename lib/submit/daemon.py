@@ -8,20 +8,36 @@
 # submit is available under the terms of the MIT/X license.  Please see the
 # file COPYING for details.
 
+from __future__ import with_statement
 from submit import *
 from submit.auth import *
 from submit.channel import *
+from submit.config import *
 from submit.deliverers import *
+from submit.deliverylog import *
 from submit.errors import *
 from submit.i18n import *
+from submit.pool import *
+from submit.spool import *
+from submit.stats import *
+import submit.hostinfo
+import collections
 import sys
 import os
+import socket
 from select import select
 import threading
+import Queue
+import time
 import traceback
 
 __all__ =  ["Daemon"]
 
+HOUSEKEEPING_INTERVAL = 10  # seconds between maintenance runs
+DEFAULT_WORKERS = 16        # number of threads talking to clients
+DEFAULT_MAX_QUEUE = 64      # clients waiting for a worker thread
+ADMISSION_INTERVAL = 0.1    # seconds between checks for room in the queue
+
 class Daemon:
     """Implementation of the submit daemon.  Accepts mails and passes them on
     to deliverers, which themselves pipe them to sendmail programs or transfer
@@ -33,6 +49,14 @@ class Daemon:
         self.sockfile = sockfile
         self.server = None
         self.passstores = {}
+        self.pool = ConnectionPool()
+        self.limits = ConcurrencyLimits()
+        self.configs = ConfigCache()
+        self.queue = Queue.Queue(max(config.get_general(int, "max_queue",
+            DEFAULT_MAX_QUEUE), 1))
+        self.spools = {}    # directory: Spool
+        self.logs = {}      # file name: DeliveryLog
+        self.lock = threading.Lock()
 
     def run(self):
         """Become a daemon and enter the mainloop."""
@@ -64,27 +88,144 @@ class Daemon:
         """Create the server socket."""
         self.server = Channel.setup(self.config, self.sockfile)
 
+    def start_workers(self, killpipe):
+        """Start the threads which take clients from the queue and talk to
+        them.  Their number is set by the `general.workers` option."""
+        workers = self.config.get_general(int, "workers", DEFAULT_WORKERS)
+        for i in xrange(max(workers, 1)):
+            thd = threading.Thread(target=self.work, args=(killpipe,))
+            thd.setDaemon(True)
+            thd.start()
+
+    def work(self, killpipe):
+        """Main function of a worker thread."""
+        while True:
+            self.handle(self.queue.get(), killpipe)
+
     def mainloop(self):
-        """Wait for clients and start threads to handle them."""
+        """Wait for clients and multiplex them until they are ready to
+        transfer their request.  Then pass them on to the worker threads.
+        Clients which are still busy (for example, reading the message from
+        their standard input) do not occupy a worker.  If the queue of
+        clients waiting for a worker is full, further clients are held back
+        in order and told how many are ahead of them (see `admit`)."""
         killin, killout = os.pipe()
         if self.server is None: self.setup_socket()
+        stats.enable()
+        self.start_workers(killout)
+        # pick up the messages left over by an earlier daemon process
+        self.get_spool(self.config)
+        for target in (self.housekeeping, self.retry_spooled):
+            thd = threading.Thread(target=target)
+            thd.setDaemon(True)
+            thd.start()
+        waiting = []
+        held = collections.deque()
         while True:
-            rlist, wlist, xlist = select([self.server, killin], [], [])
+            timeout = None
+            if held: timeout = ADMISSION_INTERVAL
+            rlist, wlist, xlist = select([self.server, killin] + waiting,
+                    [], [], timeout)
+            while held:
+                try:
+                    self.queue.put_nowait(held[0])
+                except Queue.Full:
+                    break
+                held.popleft()
+            for client in waiting[:]:
+                if client in rlist:
+                    waiting.remove(client)
+                    self.admit(client, held)
             if self.server in rlist:
                 client, addr = self.server.accept()
-                thd = threading.Thread(target=self.handle, args=(Channel(client), killout))
-                thd.setDaemon(True)
-                thd.start()
+                client = Channel(client)
+                try:
+                    client.send(ConfigRequest(SUBMIT_VERSION))
+                    waiting.append(client)
+                except socket.error:
+                    client.close()
             if killin in rlist:
                 # a thread wants us to go down
                 os.read(killin, 1)
                 os.close(killin)
+                self.pool.discard()
+                with self.lock:
+                    logs = self.logs.values()
+                for log in logs:
+                    log.close()
                 return
 
+    def admit(self, client, held):
+        """Pass `client` on to the worker threads.  If there is no room in
+        the queue, or if other clients are `held` back already, append it
+        to `held` and tell it how many clients are ahead of it instead."""
+        if not held:
+            try:
+                self.queue.put_nowait(client)
+                return
+            except Queue.Full:
+                pass
+        try:
+            client.send(QueueStatus(self.queue.qsize() + len(held)))
+            held.append(client)
+        except socket.error:
+            client.close()
+
+    def housekeeping(self):
+        """Periodic maintenance, running in a thread of its own: close
+        timed-out idle connections, keep the host name cache warm and write
+        the statistics to `general.stats_file`, if set."""
+        while True:
+            time.sleep(HOUSEKEEPING_INTERVAL)
+            self.pool.expire()
+            submit.hostinfo.refresh()
+            self.write_stats()
+
+    def write_stats(self):
+        """Write the statistics in the Prometheus text format to the file
+        given by the `general.stats_file` option."""
+        filename = self.config.get_general(str, "stats_file")
+        if not filename:
+            return
+        try:
+            stats.write_prometheus(self.config.path(filename))
+        except (IOError, OSError):
+            pass    # try again next time
+
+    def retry_spooled(self):
+        """Main function of the thread which delivers spooled messages
+        whose earlier delivery attempts have failed temporarily."""
+        while True:
+            time.sleep(HOUSEKEEPING_INTERVAL)
+            with self.lock:
+                spools = self.spools.values()
+            for spool in spools:
+                for entry in spool.due():
+                    try:
+                        self.retry(spool, entry)
+                    except Exception, e:
+                        # this thread is the only one retrying messages
+                        self.release_spooled(spool, entry, e)
+
+    def release_spooled(self, spool, entry, error):
+        """Schedule another attempt for a spool `entry` whose retry has
+        failed with the unexpected `error` (such as a full disk), and write
+        the error to the delivery log, if there is one.  The message is
+        given up once it has expired."""
+        entry.error = str(error)
+        try:
+            config = self.configs.get(entry.confdir)
+            entry.defer(config)
+            self.log_delivery(self.get_log(config), entry.message, None,
+                    {}, [], error, retry=True)
+        except Exception:
+            pass    # try again with the next round
+        entry.busy = False
+
     def handle(self, client, killpipe):
-        """Talk to a client."""
+        """Talk to a client which has already received the `ConfigRequest`
+        and is now expected to answer it."""
         try:
-            client.send(ConfigRequest(SUBMIT_VERSION))
             config = client.receive()
             if config is None:  # just a connection test, never mind
                 client.send(CloseRequest())
@@ -92,20 +233,41 @@ class Daemon:
             elif isinstance(config, ShutdownRequest):
                 # bring down the main thread
                 os.write(killpipe, ".")
-                os.close(killpipe)
                 return
+            elif isinstance(config, StatsRequest):
+                client.send(StatsReport(stats.snapshot()))
+                return
+            with timed("config"):
+                config = self.configs.get(config.confdir)
+            client.accept_files = config.get_general(bool, "pass_files", True)
 
             client.send(MessageRequest())
             msg = client.receive()
-
-            try:
-                self.deliver(client, config, msg)
-                if isinstance(msg, UnlockRequest):
-                    client.send(CloseRequest())
-                else:
-                    client.send(DeliverySuccessMessage())
-            except UserError, e:
-                client.send(e)
+            while not isinstance(msg, CloseRequest):
+                timings = {}    # stage: seconds, for the delivery log
+                if isinstance(msg, RawMessage):
+                    if msg.read_time is not None:
+                        stats.record("read", msg.read_time)
+                        timings["read"] = msg.read_time
+                    with timed("parse", timings):
+                        msg = msg.parse(config)
+                unlock = isinstance(msg, UnlockRequest)
+                try:
+                    if unlock:
+                        self.deliver(client, config, msg)
+                        client.send(CloseRequest())
+                    else:
+                        accepted = self.deliver_logged(client, config, msg,
+                                timings)
+                        if not accepted:
+                            client.send(DeliverySuccessMessage())
+                except UserError, e:
+                    client.send(e)
+                if unlock:
+                    break
+                # in batch mode, the next message follows right away;
+                # otherwise, the client simply closes the connection
+                msg = client.receive()
         except EOFError:
             pass
         except Exception, e:
@@ -115,22 +277,255 @@ class Daemon:
         finally:
             client.close()
 
-    def deliver(self, client, config, message):
+    def deliver_logged(self, client, config, message, timings):
+        """Like `deliver`, but add the time taken to `timings` and write
+        the outcome to the delivery log afterwards."""
+        # a bad log setting is reported before anything is sent
+        log = self.get_log(config)
+        # a deferred spooled message lets go of its body (see `Spool.update`)
+        size = message.get_size()
+        deliveries = []
+        try:
+            with timed("delivery", timings):
+                accepted = self.deliver(client, config, message, timings,
+                        deliveries)
+        except UserError, e:
+            exc_info = sys.exc_info()
+            self.log_delivery(log, message, size, timings, deliveries, e)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.log_delivery(log, message, size, timings, deliveries)
+        return accepted
+
+    def deliver(self, client, config, message, timings = None,
+            deliveries = None):
         """Message delivery: Deal with submission protocols and ask for
         necessary passwords.  `message` can be a `Message` or an
-        `UnlockRequest`"""
-        deliverers = message.create_deliverers(config)
-        for deliverer, rcpts in deliverers:
-            store = self.get_password_store(config, deliverer.method)
+        `UnlockRequest`.  Authenticated connections are taken from and
+        returned to the connection pool if possible.
+
+        If the configuration has a spool, the message is stored there
+        first.  As soon as all deliverers are authenticated (or have failed
+        temporarily), the client is told that the message has been accepted,
+        so that it does not have to wait for the delivery itself; true is
+        returned then.
+
+        The time spent in each stage is added to the dictionary `timings`,
+        and the outcome of each delivery is appended to the list
+        `deliveries` (see `describe_delivery`), if given."""
+        unlock = isinstance(message, UnlockRequest)
+        with timed("routing", timings):
+            deliverers = message.create_deliverers(config)
+        methods = [deliverer.method for deliverer, rcpts in deliverers]
+        spool = not unlock and self.get_spool(config)
+        if spool:
+            entry = spool.put(config.confdir, message,
+                    [(deliverer.method, rcpts)
+                        for deliverer, rcpts in deliverers])
+        with self.limits.slots(config, methods):
+            jobs = []
             try:
-                deliverer.authenticate(ChannelAuthenticator(store, client))
-                if isinstance(message, UnlockRequest):
+                with timed("authenticate", timings):
+                    jobs, deferred = self.authenticate(config, deliverers,
+                            client, unlock, bool(spool))
+                if spool:
+                    client.send(DeliverySuccessMessage())
+            except:
+                # the client has not been told that the message is spooled
+                # (it may have gone away while being asked for a password),
+                # so don’t deliver it behind its back
+                exc_info = sys.exc_info()
+                if spool:
+                    for deliverer, rcpts in jobs:
+                        deliverer.abort()
+                    spool.remove(entry)
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+            if unlock:
+                for deliverer, rcpts in jobs:
                     deliverer.abort()
+            elif spool:
+                try:
+                    self.deliver_spooled(config, spool, entry, message, jobs,
+                            deferred, deliveries)
+                except:
+                    # let `retry_spooled` pick the message up again
+                    entry.busy = False
+                    raise
+                return True
+            else:
+                deliver_all(message, jobs, self.pool.release,
+                        make_report(deliveries))
+        return False
+
+    def authenticate(self, config, deliverers, client, unlock = False,
+            spooled = False):
+        """Authenticate the (deliverer, recipients) pairs in `deliverers`
+        one after another, as this may involve asking the user through the
+        `client` channel (or nobody, if `client` is `None`).  Return a list
+        of the authenticated pairs and a list of (method, recipients,
+        error message) tuples describing temporary failures, which are only
+        tolerated for `spooled` messages."""
+        jobs = []
+        deferred = []
+        try:
+            for deliverer, rcpts in deliverers:
+                store = self.get_password_store(config, deliverer.method)
+                pooled = not unlock and self.pool.acquire(deliverer)
+                if pooled:
+                    jobs.append((pooled, rcpts))
+                    continue
+                if client is None:
+                    auth = SpoolAuthenticator(store)
                 else:
-                    deliverer.deliver(message, rcpts)
-            except UserError, e:
+                    auth = ChannelAuthenticator(store, client)
+                try:
+                    deliverer.authenticate(auth)
+                except TemporaryFailure, e:
+                    if not spooled: raise
+                    deliverer.abort()
+                    deferred.append((deliverer.method, rcpts, str(e)))
+                    continue
+                jobs.append((deliverer, rcpts))
+        except:
+            # whatever went wrong (the client may have gone away while
+            # being asked for a password), don’t leave connections open
+            exc_info = sys.exc_info()
+            deliverer.abort()
+            for deliverer, rcpts in jobs:
                 deliverer.abort()
-                raise
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return jobs, deferred
+
+    def deliver_spooled(self, config, spool, entry, message, jobs, deferred,
+            deliveries = None):
+        """Deliver the spooled `message` through the authenticated `jobs`
+        and update its spool `entry`.  `deferred` lists the methods whose
+        authentication has failed temporarily (see `authenticate`).  The
+        outcome of each delivery is appended to `deliveries`, if given."""
+        retry = deferred[:]
+        if deliveries is not None:
+            for method, rcpts, error in deferred:
+                deliveries.append(dict(method=method, rcpts=len(rcpts),
+                    status="deferred", error=error))
+        delivered = []  # deliverers which have succeeded
+
+        def finish(deliverer):
+            delivered.append(deliverer)
+            self.pool.release(deliverer)
+        try:
+            failed = deliver_each(message, jobs, finish,
+                    make_report(deliveries))
+        except:
+            # whatever has been delivered must not be sent again
+            exc_info = sys.exc_info()
+            routes = [(method, rcpts) for method, rcpts, e in retry]
+            routes += [(deliverer.method, rcpts) for deliverer, rcpts in jobs
+                    if deliverer not in delivered]
+            try:
+                spool.update(entry, routes, str(exc_info[1]), config)
+            except (IOError, OSError):
+                pass    # the remaining routes are kept in memory at least
+            raise exc_info[0], exc_info[1], exc_info[2]
+        for deliverer, rcpts, exc_info in failed:
+            # only some of the recipients may be left
+            rcpts = getattr(exc_info[1], "rcpts", None) or rcpts
+            if isinstance(exc_info[1], TemporaryFailure):
+                retry.append((deliverer.method, rcpts, str(exc_info[1])))
+            else:
+                entry.failed.append((deliverer.method, rcpts,
+                    str(exc_info[1])))
+        error = None
+        if retry: error = retry[-1][2]
+        spool.update(entry, [(method, rcpts) for method, rcpts, e in retry],
+                error, config)
+
+    def retry(self, spool, entry):
+        """Try to deliver the message of a spool `entry` again."""
+        config = self.configs.get(entry.confdir)
+        try:
+            log = self.get_log(config)
+        except ConfigError:
+            # the user learns about it when submitting the next message
+            log = None
+        timings = {}
+        deliveries = []
+        message = size = error = None
+        try:
+            message = spool.load(entry)
+            size = message.get_size()
+            deliverers = config.create_deliverers(entry.routes)
+            methods = [deliverer.method for deliverer, rcpts in deliverers]
+            with self.limits.slots(config, methods):
+                with timed("authenticate", timings):
+                    jobs, deferred = self.authenticate(config, deliverers,
+                            None, spooled=True)
+                self.deliver_spooled(config, spool, entry, message, jobs,
+                        deferred, deliveries)
+        except UserError, e:
+            entry.failed.extend([(method, rcpts, str(e))
+                for method, rcpts in entry.routes])
+            spool.update(entry, [], None, config)
+            error = e
+        except Exception, e:
+            # keep the message and try again later, unless `deliver_spooled`
+            # has already recorded what is left
+            if entry.busy:
+                spool.update(entry, entry.routes, str(e), config)
+            return
+        if message is not None:
+            self.log_delivery(log, message, size, timings, deliveries,
+                    error, retry=True)
+
+    def get_spool(self, config):
+        """Return the `Spool` in the directory set by `general.spool`, or
+        `None` if messages are not to be spooled."""
+        path = config.get_general(str, "spool")
+        if not path:
+            return None
+        path = config.path(path)
+        with self.lock:
+            spool = self.spools.get(path)
+            if spool is None:
+                spool = self.spools[path] = Spool(path)
+        return spool
+
+    def get_log(self, config):
+        """Return the `DeliveryLog` writing to the file set by
+        `general.delivery_log`, or `None` if deliveries are not logged."""
+        path = config.get_general(str, "delivery_log")
+        if not path:
+            return None
+        path = config.path(path)
+        with self.lock:
+            log = self.logs.get(path)
+            if log is None:
+                log = self.logs[path] = DeliveryLog(path)
+        log.configure(config)
+        return log
+
+    def log_delivery(self, log, message, size, timings, deliveries,
+            error = None, retry = False):
+        """Write a record about the delivery of `message`, which is `size`
+        bytes long, to the `DeliveryLog` `log` (see `get_log`), unless it is
+        `None`: the time spent in each stage (`timings`), the outcome of the
+        deliveries through each method (see `describe_delivery`) and the
+        `error` which has ended the delivery, if any.  `retry` tells
+        whether the message has come from the spool.  Errors are ignored,
+        so that logging cannot change the outcome of the delivery."""
+        if log is None:
+            return
+        try:
+            record = dict(time=time.time(),
+                    message_id=message.message.get("Message-ID"),
+                    size=size, rcpts=len(message.rcpts),
+                    stages=round_timings(timings), deliveries=deliveries)
+            if retry:
+                record["retry"] = True
+            if error is not None:
+                record["error"] = str(error)
+            log.write(record)
+        except Exception:
+            pass
 
     def get_password_store(self, config, method):
         """Get the password store for the given delivery method.  If there is
@@ -143,9 +538,101 @@ class Daemon:
             timeout = config.get_method(int, method, "expire")
             if not timeout:
                 timeout = config.get_general(int, "expire", 60)
-            store.expire(60 * timeout)
+            if store.expire(60 * timeout):
+                # don’t let pooled sessions outlive the passwords
+                self.pool.discard(method)
         return store
 
+def round_timings(timings):
+    """Round the durations in the dictionary `timings` to microseconds."""
+    return dict([(stage, round(seconds, 6))
+        for stage, seconds in timings.iteritems()])
+
+def describe_delivery(deliverer, rcpts, exc_info):
+    """Describe the delivery of a message through `deliverer` to `rcpts`
+    for the delivery log: a dictionary containing the method, the number
+    of recipients, the time spent in each stage, the SMTP reply codes and
+    the status (`sent`, `deferred` or `failed`, along with the error
+    message).  `exc_info` is `None` or describes the failure."""
+    delivery = dict(method=deliverer.method, rcpts=len(rcpts),
+            stages=round_timings(deliverer.timings),
+            replies=deliverer.replies, status="sent")
+    if exc_info is not None:
+        if isinstance(exc_info[1], TemporaryFailure):
+            delivery["status"] = "deferred"
+        else:
+            delivery["status"] = "failed"
+        delivery["error"] = str(exc_info[1])
+    return delivery
+
+def make_report(deliveries):
+    """Return a function to be passed as `report` to `deliver_each` which
+    appends the outcome of each delivery to the list `deliveries`, or
+    `None` if `deliveries` is `None`."""
+    if deliveries is None:
+        return None
+    def report(deliverer, rcpts, exc_info):
+        deliveries.append(describe_delivery(deliverer, rcpts, exc_info))
+    return report
+
+class ConcurrencyLimits:
+    """Limits on the number of simultaneous deliveries per delivery method,
+    as set by the `concurrency` option of the method section."""
+
+    def __init__(self):
+        """Create a new set of limits."""
+        self.semaphores = {}    # method: (limit, semaphore or None)
+        self.lock = threading.Lock()
+
+    def get_semaphore(self, config, method):
+        """Return the semaphore guarding `method`, or `None` if the method
+        is not limited."""
+        limit = config.get_method(int, method, "concurrency", 0)
+        with self.lock:
+            current = self.semaphores.get(method)
+            if current is None or current[0] != limit:
+                if limit > 0:
+                    semaphore = threading.Semaphore(limit)
+                else:
+                    semaphore = None
+                current = self.semaphores[method] = (limit, semaphore)
+        return current[1]
+
+    def slots(self, config, methods):
+        """Return a context manager which waits for the permission to
+        deliver via all of the given `methods` and holds it until it is
+        left.  The semaphores are always acquired in the same order, so
+        that concurrent deliveries cannot deadlock."""
+        semaphores = [self.get_semaphore(config, method)
+                for method in sorted(set(methods))]
+        return DeliverySlots([sem for sem in semaphores if sem is not None])
+
+class DeliverySlots:
+    """A context manager acquiring and releasing a list of semaphores."""
+
+    def __init__(self, semaphores):
+        """Create a slot guarded by the given `semaphores`."""
+        self.semaphores = semaphores
+
+    def __enter__(self):
+        """Wait for the semaphores."""
+        for semaphore in self.semaphores:
+            semaphore.acquire()
+
+    def __exit__(self, *exc_info):
+        """Release the semaphores."""
+        for semaphore in reversed(self.semaphores):
+            semaphore.release()
+
+class SpoolAuthenticator(AbstractAuthenticator):
+    """An authenticator for spooled messages, which are delivered when there
+    is nobody to ask for passwords.  Only stored passwords can be used."""
+
+    def query_password(self, key, query, first):
+        """Defer the delivery until the password is known again."""
+        raise DeliveryDeferredError(n_("The password for %(method)s is not "
+            "known at the moment."), method=self.store.method)
+
 class ChannelAuthenticator(AbstractAuthenticator):
     """An authenticator forwarding password requests to the frontend
     process."""
@@ -157,8 +644,10 @@ class ChannelAuthenticator(AbstractAuthenticator):
 
     def query_password(self, key, query, first):
         """Ask for the passphrase on the channel connected with the client."""
-        self.channel.send(PasswordRequest(self.store.method, key, query, first))
-        response = self.channel.receive()
+        with timed("password"):
+            self.channel.send(PasswordRequest(self.store.method, key, query,
+                first))
+            response = self.channel.receive()
         if isinstance(response, PasswordResponse):
             return response.password
         else:
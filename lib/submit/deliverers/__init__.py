@@ -8,9 +8,14 @@
 # submit is available under the terms of the MIT/X license.  Please see the
 # file COPYING for details.
 
+from __future__ import with_statement
 from submit.errors import *
+from submit.i18n import *
+from submit.stats import timed
+import sys
+import threading
 
-__all__ = ["AbstractDeliverer"]
+__all__ = ["AbstractDeliverer", "deliver_each", "deliver_all"]
 
 class AbstractDeliverer:
     """An abstract deliverer.  Deliverers submitting to sendmail programs or
@@ -19,9 +24,16 @@ class AbstractDeliverer:
     def __init__(self, config, method):
         """Initialize a deliverer responsible for transmitting a `message` to
         some recipients.  Configuration parameters should be retrieved from
-        the `method` delivery section via the given `Config` instance."""
+        the `method` delivery section via the given `Config` instance.
+
+        While the daemon process is running, the time spent in each stage
+        (see `submit.stats.timed`) is added up in `timings`, and the codes
+        of the SMTP replies are collected in `replies`, for the delivery
+        log.  Both are cleared once the message has been delivered."""
         self.config = config
         self.method = method
+        self.timings = {}
+        self.replies = []
 
     def needs_authentication(self):
         """Find out whether manual password input is likely to be needed."""
@@ -35,14 +47,120 @@ class AbstractDeliverer:
 
     def deliver(self, message, rcpts):
         """Transmit the message.  `authenticate` will always be called
-        immediately before this method.  If a network socket gets opened in
-        `authenticate`, there is no need to worry about timeouts."""
+        before this method, either immediately or before an earlier delivery
+        if the deliverer has been kept in a `ConnectionPool`.  Call `close`
+        afterwards unless the deliverer is to be reused."""
         raise NotImplementedError, "abstract deliver() called"
 
+    def fan_out(self, rcpts):
+        """Split `rcpts` into groups which are delivered in parallel, each
+        by its own deliverer.  Return a non-empty list of recipient lists;
+        the default implementation keeps all recipients together."""
+        return [rcpts]
+
+    def close(self):
+        """Close the connection properly after successful delivery.  The
+        default implementation does nothing."""
+
+    def pool_key(self):
+        """Return a hashable key identifying deliverers whose authenticated
+        connections can be shared, or `None` if this deliverer cannot be kept
+        open between deliveries (the default)."""
+        return None
+
+    def reset(self):
+        """Prepare a pooled deliverer for another delivery.  Return false if
+        its connection is no longer usable."""
+        return False
+
+    def ping(self):
+        """Check whether the connection of an idle pooled deliverer is still
+        alive."""
+        return False
+
     def abort(self):
         """Close the connection properly after authentication.  This method is
         called *instead of* `deliver` if the authentication has failed or if
         there is no message to deliver (unlock mode)."""
         raise NotImplementedError, "abstract abort() called"
 
+def deliver_each(message, jobs, finish, report = None):
+    """Deliver `message` through all (deliverer, recipients) pairs in `jobs`
+    at the same time.  The deliverers must already be authenticated.  Each
+    deliverer that succeeds is passed to `finish` (which usually closes it);
+    the others are aborted.  Before that, `report` is called, if given, with
+    the deliverer, its recipients and the exc_info tuple of its failure or
+    `None`.  Return the failed jobs as a list of (deliverer, recipients,
+    exc_info) tuples."""
+    results = [None] * len(jobs)
+
+    def run(index):
+        deliverer, rcpts = jobs[index]
+        try:
+            with timed("data", deliverer.timings):
+                deliverer.deliver(message, rcpts)
+        except:
+            results[index] = sys.exc_info()
+
+    threads = []
+    for index in xrange(1, len(jobs)):
+        thd = threading.Thread(target=run, args=(index,))
+        thd.setDaemon(True)
+        thd.start()
+        threads.append(thd)
+    if jobs:
+        run(0)
+    for thd in threads:
+        thd.join()
+
+    failed = []
+    for (deliverer, rcpts), result in zip(jobs, results):
+        if report is not None:
+            report(deliverer, rcpts, result)
+        # a pooled deliverer starts afresh with the next message
+        deliverer.timings, deliverer.replies = {}, []
+        if result is None:
+            finish(deliverer)
+        else:
+            deliverer.abort()
+            failed.append((deliverer, rcpts, result))
+    return failed
+
+def deliver_all(message, jobs, finish, report = None):
+    """Like `deliver_each`, but if any delivery fails, raise a
+    `DeliveryError` describing all failures after the other deliveries have
+    completed."""
+    failed_jobs = deliver_each(message, jobs, finish, report)
+    failed_deliverers = [deliverer for deliverer, rcpts, exc_info
+            in failed_jobs]
+    failed = [(deliverer.method, exc_info)
+            for deliverer, rcpts, exc_info in failed_jobs]
+    succeeded = [deliverer.method for deliverer, rcpts in jobs
+            if deliverer not in failed_deliverers]
+
+    if not failed:
+        return
+    for method, exc_info in failed:
+        # programming errors take precedence
+        if not isinstance(exc_info[1], UserError):
+            raise exc_info[0], exc_info[1], exc_info[2]
+    if len(failed) == 1 and not succeeded:
+        exc_info = failed[0][1]
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    if len(failed) == 1:
+        details = str(failed[0][1][1])
+    else:
+        details = "; ".join(["%s: %s" % (method, exc_info[1])
+            for method, exc_info in failed])
+    methods = ", ".join([method for method, exc_info in failed])
+    if succeeded:
+        raise DeliveryFailedError(n_("Delivery via %(failed)s failed "
+            "(%(details)s), but the message has been delivered via "
+            "%(succeeded)s."), failed=methods, details=details,
+            succeeded=", ".join(succeeded))
+    else:
+        raise DeliveryFailedError(n_("Delivery via %(failed)s failed: "
+            "%(details)s"), failed=methods, details=details)
+
 # vim:tw=78:fo-=t:sw=4:sts=4:et:
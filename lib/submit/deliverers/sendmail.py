@@ -11,56 +11,344 @@
 from submit.deliverers import *
 from submit.errors import *
 from submit.i18n import *
+from select import select
+import errno
+import fcntl
 import os
 import shlex
+import socket
 import subprocess
+import time
 
 __all__ = ["SendmailDeliverer"]
 
+EX_TEMPFAIL = 75        # exit status for temporary failures (sysexits.h)
+DEFAULT_TIMEOUT = 300   # seconds sendmail may take for a message
+STDERR_LIMIT = 8192     # bytes of error output kept for the error message
+READ_SIZE = 4096        # bytes of error output read at once
+
 class SendmailDeliverer(AbstractDeliverer):
-    """A deliverer submitting messages using a sendmail-compatible program."""
+    """A deliverer submitting messages using a sendmail-compatible program.
+    Normally, the program is run once per message.  With the `persistent`
+    option, it is started as `sendmail -bs` instead and fed the messages
+    using SMTP, so that the daemon process can keep it running between
+    deliveries."""
+
+    # resolved command lines, keyed by the `program` and `arguments`
+    # options: (program, argv) tuples
+    commands = {}
 
     def needs_authentication(self):
         """Sendmail-based delivery methods never ask for authentication."""
         return False
 
     def authenticate(self, auth):
-        """No authentication needed; do nothing."""
+        """In persistent mode, start the sendmail program.  Otherwise,
+        there is nothing to do."""
+        if self.is_persistent():
+            self.start_session()
 
     def abort(self):
-        """Abort after a failed authentication procedure.  Authentication will
-        never fail; still, do nothing."""
+        """Abort after a failed authentication procedure, stopping the
+        sendmail program if it runs in persistent mode."""
+        if self.is_persistent() and getattr(self, "conn", None) is not None:
+            self.conn.close()
 
-    def deliver(self, message, rcpts):
-        """Pipe the message through sendmail."""
-        program = self.config.get_method(str, self.method, "program",
-                default_sendmail)
-        if not program:
-            raise DeliveryFailedError(n_(
-                "Unable to find sendmail program."))
-        sendmail = shlex.split(program)
+    def is_persistent(self):
+        """Determine whether the `persistent` option is set."""
+        return self.config.get_method(bool, self.method, "persistent", False)
+
+    def get_command(self):
+        """Return the program name (for error messages) and the command line
+        to run as a list.  Both are only determined once per process for the
+        same options."""
+        program = self.config.get_method(str, self.method, "program")
         args = self.config.get_method(str, self.method, "arguments",
                 "-oem -oi")
-        if args: args = shlex.split(args)
-        else: args = []
+        key = (program, args)
+        command = self.commands.get(key)
+        if command is None:
+            if program is None:
+                program = default_sendmail()
+            if not program:
+                raise DeliveryFailedError(n_(
+                    "Unable to find sendmail program."))
+            argv = shlex.split(program)
+            if args: argv += shlex.split(args)
+            command = self.commands[key] = (program, argv)
+        return command
 
-        cmd = sendmail + args + ["-f", message.efrom] + rcpts
+    def deliver(self, message, rcpts):
+        """Pipe the message through sendmail, or send it to the running
+        sendmail program in persistent mode."""
+        if self.is_persistent():
+            return self.deliver_session(message, rcpts)
+
+        program, argv = self.get_command()
+        timeout = self.config.get_method(int, self.method, "timeout",
+                DEFAULT_TIMEOUT)
+        cmd = argv + ["-f", message.efrom] + rcpts
         proc = subprocess.Popen(cmd,
                 stdin = subprocess.PIPE, stderr = subprocess.PIPE)
-        proc.stdin.write(message.get_body())
-        proc.stdin.close()
+        status, details = communicate(proc, message.chunks(), timeout)
 
-        if proc.wait() != 0:
-            details = proc.stderr.read().strip()
+        if status is None:
+            raise DeliveryDeferredError(n_('"%(program)s" did not finish '
+                'within %(timeout)d seconds.'), program=program,
+                timeout=timeout)
+        elif status != 0:
+            if status == EX_TEMPFAIL:
+                error = DeliveryDeferredError
+            else:
+                error = DeliveryFailedError
+            details = details.strip()
             if details:
-                raise DeliveryFailedError(n_('"%(program)s" failed: %(details)s.'),
+                raise error(n_('"%(program)s" failed: %(details)s.'),
                         program=program, details=details)
             else:
-                raise DeliveryFailedError(n_('"%(program)s" failed with unknown error.'),
+                raise error(n_('"%(program)s" failed with unknown error.'),
                         program=program)
 
+    def start_session(self):
+        """Run `sendmail -bs` and greet it."""
+        from submit.deliverers.smtp import SMTP
+        import smtplib
+        program, argv = self.get_command()
+        timeout = self.config.get_method(int, self.method, "timeout",
+                DEFAULT_TIMEOUT)
+        try:
+            proc = subprocess.Popen(argv + ["-bs"], stdin = subprocess.PIPE,
+                    stdout = subprocess.PIPE, close_fds = True)
+        except OSError, e:
+            raise DeliveryFailedError(n_('"%(program)s" failed: %(details)s.'),
+                    program=program, details=e.strerror)
+        self.conn = SMTP(local_hostname="localhost")
+        # accepting the message is no different from any other reply
+        self.conn.data_timeout = timeout
+        try:
+            self.conn.attach(PipeSocket(proc, timeout))
+            self.conn.ehlo()
+        except (socket.error, smtplib.SMTPException), e:
+            self.conn.close()
+            self.session_error(e)
+
+    def deliver_session(self, message, rcpts):
+        """Transmit the message to the running `sendmail -bs`."""
+        from submit.deliverers.smtp import check_reply
+        import smtplib
+        try:
+            check_reply(self.conn.mail(message.efrom), self.replies)
+            for rcpt in rcpts:
+                check_reply(self.conn.rcpt(rcpt), self.replies)
+            check_reply(self.conn.data_lines(message.lines()), self.replies)
+        except (socket.error, smtplib.SMTPException), e:
+            self.session_error(e)
+
+    def session_error(self, e):
+        """Raise a `DeliveryError` for the exception `e` raised while
+        talking to `sendmail -bs`."""
+        from submit.deliverers.smtp import is_temporary
+        if is_temporary(e):
+            error = DeliveryDeferredError
+        else:
+            error = DeliveryFailedError
+        raise error(n_('"%(program)s" failed: %(details)s.'),
+                program=self.get_command()[0], details=str(e))
+
+    def close(self):
+        """In persistent mode, tell the sendmail program to exit."""
+        import smtplib
+        if not self.is_persistent(): return
+        try:
+            self.conn.quit()
+        except (socket.error, smtplib.SMTPException):
+            self.conn.close()
+
+    def pool_key(self):
+        """In persistent mode, the sendmail program is kept running between
+        deliveries using the same configuration of the delivery method."""
+        if not self.is_persistent(): return None
+        return (self.__class__, self.method,
+                self.config.get_method_items(self.method))
+
+    def reset(self):
+        """Abort any pending transaction of a pooled sendmail program."""
+        import smtplib
+        try:
+            return self.conn.rset()[0] == 250
+        except (socket.error, smtplib.SMTPException):
+            return False
+
+    def ping(self):
+        """Check whether a pooled sendmail program still responds."""
+        import smtplib
+        try:
+            return self.conn.noop()[0] == 250
+        except (socket.error, smtplib.SMTPException):
+            return False
+
+class PipeSocket:
+    """Enough of a socket for `smtplib` to talk to a `sendmail -bs` process
+    through its standard input and output.  Like a socket with a timeout,
+    it waits for at most `timeout` seconds to write data or to read a line;
+    if the process takes longer, it is killed and `socket.timeout` is
+    raised."""
+
+    def __init__(self, proc, timeout):
+        """Wrap the `subprocess.Popen` object `proc`."""
+        self.proc = proc
+        self.timeout = timeout
+        stdin = proc.stdin.fileno()
+        flags = fcntl.fcntl(stdin, fcntl.F_GETFL)
+        fcntl.fcntl(stdin, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def gettimeout(self):
+        """Return the timeout in seconds."""
+        return self.timeout
+
+    def settimeout(self, timeout):
+        """Change the timeout to `timeout` seconds."""
+        self.timeout = timeout
+
+    def sendall(self, data):
+        """Write `data` to the standard input of the process.  Errors are
+        raised as `socket.error`, which is what `smtplib` expects."""
+        deadline = time.time() + self.timeout
+        stdin = self.proc.stdin.fileno()
+        while data:
+            self.wait([], [stdin], deadline)
+            try:
+                data = data[os.write(stdin, data):]
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise socket.error(e.errno, e.strerror)
+
+    def wait(self, rlist, wlist, deadline):
+        """Wait until one of the file descriptors in `rlist` can be read or
+        one in `wlist` can be written.  If this does not happen before
+        `deadline`, kill the process and raise `socket.timeout`."""
+        remaining = deadline - time.time()
+        if remaining > 0:
+            rlist, wlist, xlist = select(rlist, wlist, [], remaining)
+            if rlist or wlist:
+                return
+        try:
+            self.proc.kill()
+        except OSError:
+            pass
+        raise socket.timeout("timed out")
+
+    def makefile(self, mode = "r", bufsize = -1):
+        """Return the standard output of the process as a `PipeFile`."""
+        return PipeFile(self)
+
+    def close(self):
+        """Close standard input, which makes the process exit, and collect
+        it.  Whatever it has accepted is queued at this point, so it is
+        terminated if it does not exit by itself."""
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        if self.proc.poll() is None:
+            try:
+                self.proc.terminate()
+            except OSError:
+                pass
+        self.proc.wait()
+
+class PipeFile:
+    """The standard output of a `sendmail -bs` process, from which lines
+    are read within the timeout of its `PipeSocket`."""
+
+    def __init__(self, sock):
+        """Read from the process of `sock`."""
+        self.sock = sock
+        self.buffer = ""
+
+    def readline(self, size = -1):
+        """Return the next line, or at most `size` bytes of it."""
+        deadline = time.time() + self.sock.timeout
+        stdout = self.sock.proc.stdout.fileno()
+        while "\n" not in self.buffer and not 0 <= size <= len(self.buffer):
+            self.sock.wait([stdout], [], deadline)
+            data = os.read(stdout, READ_SIZE)
+            if not data:
+                break
+            self.buffer += data
+        end = self.buffer.find("\n") + 1 or len(self.buffer)
+        if size >= 0:
+            end = min(end, size)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+    def close(self):
+        """Close the standard output of the process."""
+        self.sock.proc.stdout.close()
+
 Deliverer = SendmailDeliverer
 
+def communicate(proc, chunks, timeout):
+    """Write the strings from `chunks` to the standard input of the process
+    `proc` while reading its error output, so that neither pipe can fill up
+    and block the other, and wait for the process to exit.  Return its exit
+    status and the first `STDERR_LIMIT` bytes of its error output.  If this
+    takes longer than `timeout` seconds, the process is killed and the
+    status is `None`."""
+    deadline = time.time() + timeout
+    stdin = proc.stdin.fileno()
+    stderr = proc.stderr.fileno()
+    flags = fcntl.fcntl(stdin, fcntl.F_GETFL)
+    fcntl.fcntl(stdin, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    chunks = iter(chunks)
+    pending = ""
+    writing = reading = True
+    errors = []
+    captured = 0
+
+    while writing or reading:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        rlist, wlist, xlist = select(reading and [stderr] or [],
+                writing and [stdin] or [], [], remaining)
+        if wlist:
+            if not pending:
+                pending = next(chunks, None)
+            if pending is None:
+                proc.stdin.close()
+                writing = False
+            else:
+                try:
+                    pending = pending[os.write(stdin, pending):]
+                except OSError, e:
+                    if e.errno == errno.EPIPE:
+                        # sendmail has given up; its status will tell why
+                        proc.stdin.close()
+                        writing = False
+                    elif e.errno != errno.EAGAIN:
+                        raise
+        if rlist:
+            data = os.read(stderr, READ_SIZE)
+            if not data:
+                reading = False
+            elif captured < STDERR_LIMIT:
+                errors.append(data[:STDERR_LIMIT - captured])
+                captured += len(errors[-1])
+
+    for pipe in (proc.stdin, proc.stderr):
+        pipe.close()
+    while proc.poll() is None and time.time() < deadline:
+        time.sleep(0.01)
+    if proc.poll() is None:
+        try:
+            proc.kill()
+        except OSError:
+            pass
+        proc.wait()
+        return None, "".join(errors)
+    return proc.returncode, "".join(errors)
+
 def default_sendmail():
     """Determine the path to the MTA sendmail implementation.  Take into
     account that `submit` itself might be called `sendmail`; in this case,
@@ -8,33 +8,66 @@
 # submit is available under the terms of the MIT/X license.  Please see the
 # file COPYING for details.
 
+from __future__ import with_statement
 from submit.i18n import *
 from submit.deliverers import *
 from submit.errors import *
-from submit.message import default_mailname
+from submit.hostinfo import *
+from submit.relays import *
+from submit.stats import monotonic, record, timed, Stopwatch
+import os
+import select
 import smtplib
 import socket
 import re
-from OpenSSL import crypto, SSL
+import sys
+import threading
 
-__all__ = ["SMTPDeliverer"]
+__all__ = ["SMTP", "SMTPDeliverer", "is_temporary", "resume_session",
+        "remember_session", "tls_handshake", "ssl_error_details"]
+
+DATA_BUFFER_SIZE = 64 * 1024    # send DATA in pieces of about this size
+PIPELINE_GROUP = 100            # commands sent at once when pipelining
+BDAT_WINDOW = 16                # chunks sent ahead of their replies
+DEFAULT_TIMEOUT = 30            # seconds to wait for a relay
+DEFAULT_DATA_TIMEOUT = 600      # seconds to wait for the end of data reply
+DEFAULT_MAX_RCPTS = 100         # recipients per transaction (RFC 5321)
 
 class SMTP(smtplib.SMTP):
     """An SMTP client implementation supporting OpenSSL-based STARTTLS
-    facilities."""
+    facilities.  Like everywhere in this module, pyOpenSSL is only imported
+    once TLS is actually used."""
+
+    data_timeout = DEFAULT_DATA_TIMEOUT
+
+    def attach(self, sock, fileobj = None):
+        """Use the connected socket `sock` (and `fileobj` to read from it,
+        if given) and read the greeting of the server.  If it is not
+        positive, an `SMTPConnectError` is raised."""
+        self.sock = sock
+        self.file = fileobj
+        (code, msg) = self.getreply()
+        if code != 220:
+            self.close()
+            raise smtplib.SMTPConnectError(code, msg)
+        return (code, msg)
 
-    def starttls(self, context):
+    def starttls(self, context, session = None):
         """Start a TLS session.  The SSL parameters are taken from the
-        `context` parameter.
+        `context` parameter.  If a `session` of an earlier connection to
+        the same server is given, try to resume it.
 
         Don’t forget to re-EHLO afterwards, some servers will refuse to
         continue if this step is missing."""
+        from OpenSSL import SSL
         (resp, reply) = self.docmd("STARTTLS")
         if resp == 220:
-            self.sock = SSL.Connection(context, self.sock)
+            sock = self.sock
+            self.sock = SSL.Connection(context, sock)
             self.file = smtplib.SSLFakeFile(self.sock)
+            resume_session(self.sock, session)
             self.sock.set_connect_state()
-            self.sock.do_handshake()
+            tls_handshake(self.sock, sock)
             # and suddenly, the server is a stranger again (RFC 3207, 4.2)
             self.helo_resp = None
             self.ehlo_resp = None
@@ -42,6 +75,78 @@ class SMTP(smtplib.SMTP):
             self.does_esmtp = 0
         return (resp, reply)
 
+    def pipeline(self, commands):
+        """Send all of the given `commands` at once without waiting for the
+        replies in between (RFC 2920), then return the list of (code,
+        message) replies.  Only use this if the server supports the
+        PIPELINING extension."""
+        self.send("".join([command + smtplib.CRLF for command in commands]))
+        return [self.getreply() for command in commands]
+
+    def data_lines(self, lines):
+        """Like `data`, but take the message from an iterable of `lines` and
+        send it piece by piece instead of quoting it as a whole.  Line
+        endings are converted to CRLF and leading periods are doubled."""
+        (code, repl) = self.docmd("DATA")
+        if code != 354:
+            raise smtplib.SMTPDataError(code, repl)
+        return self.send_lines(lines)
+
+    def send_lines(self, lines):
+        """Send the message in `lines` after the server has accepted the
+        DATA command (see `data_lines`) and return its final reply."""
+        for chunk in crlf_chunks(lines, True):
+            self.send(chunk)
+        self.send("." + smtplib.CRLF)
+        return self.final_reply()
+
+    def bdat_lines(self, lines, window = 1):
+        """Send the message in `lines` using BDAT commands (RFC 3030) and
+        return the reply to the last one.  Line endings are converted to
+        CRLF, but there is no need to double leading periods.  Up to
+        `window` chunks are sent before the reply to the first one is read;
+        only use values above 1 if the server supports pipelining."""
+        pending = 0
+        previous = None
+        for chunk in crlf_chunks(lines):
+            if previous is not None:
+                self.send("BDAT %d%s%s" % (len(previous), smtplib.CRLF,
+                    previous))
+                pending += 1
+                if pending >= window:
+                    self.check_chunk()
+                    pending -= 1
+            previous = chunk
+        previous = previous or ""
+        self.send("BDAT %d LAST%s%s" % (len(previous), smtplib.CRLF, previous))
+        return self.final_reply(pending)
+
+    def final_reply(self, pending = 0):
+        """Read the replies to `pending` BDAT commands which are not the
+        last one (see `check_chunk`), then the reply to the end of the
+        message.  The server may scan the message before answering, so the
+        timeout of the socket is raised to `data_timeout` seconds
+        meanwhile (RFC 5321, 4.5.3.2)."""
+        sock = self.sock
+        timeout = sock.gettimeout()
+        if timeout is not None:
+            sock.settimeout(max(timeout, self.data_timeout))
+        try:
+            while pending > 0:
+                self.check_chunk()
+                pending -= 1
+            return self.getreply()
+        finally:
+            # unless the connection has been closed because of an error
+            if timeout is not None and self.sock is sock:
+                sock.settimeout(timeout)
+
+    def check_chunk(self):
+        """Read the reply to a BDAT command which is not the last one."""
+        (code, repl) = self.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, repl)
+
 class SMTPDeliverer(AbstractDeliverer):
     """A deliverer submitting messages to SMTP servers."""
 
@@ -58,34 +163,134 @@ class SMTPDeliverer(AbstractDeliverer):
         """Open a connection to an SMTP server."""
         c = self.config
 
-        self.host = host = c.get_method(str, self.method, "host")
-        port = c.get_method(int, self.method, "port", smtplib.SMTP_PORT)
-        try:
-            self.conn = SMTP(host, port)
-        except:
-            raise AuthenticationFailedError(
-                    n_("Unable to open connection to %(host)s."), host=host)
+        def start(sock):
+            self.conn = SMTP(local_hostname=get_fqdn())
+            self.conn.attach(sock)
+        self.connect(smtplib.SMTP_PORT, start)
 
         try:
             self.ehlo()
             starttls = c.get_method(bool, self.method, "starttls", False)
             if starttls:
-                self.tls_setup(auth)
-            self.sasl_auth(auth)
+                with timed("tls", self.timings):
+                    self.tls_setup(auth)
+            with timed("sasl", self.timings):
+                self.sasl_auth(auth)
         except (socket.error, smtplib.SMTPException), e:
-            raise AuthenticationFailedError(
-                    n_("Error while talking to %(host)s: %(details)s"),
-                    host=host, details=str(e))
+            if is_temporary(e):
+                error = ConnectionFailedError
+            else:
+                error = AuthenticationFailedError
+            raise error(n_("Error while talking to %(host)s: %(details)s"),
+                    host=self.host, details=str(e))
+
+    def connect(self, default_port, start, handshake = None, errors = ()):
+        """Connect to one of the relays listed in the `host` option and
+        call `start` with the socket to set up `self.conn`.  If
+        `handshake` is given, it is called with the socket first and
+        returns the object (such as a TLS connection) passed to `start`
+        instead.  Relays which have recently failed are tried last (see
+        `RelayHealth`); each one gets `timeout` seconds to accept the
+        connection.  Besides network and SMTP errors, exceptions of the
+        types in `errors` (meant for failures of the handshake itself, not
+        for a peer which turns out not to be trusted) make the next relay be
+        tried; if every relay has failed that way, the last one of them is
+        raised.  Any other exception is passed on without holding it against
+        the relay.  `self.host` and `self.port` are set to the relay in use.
+
+        Connecting and reading the greeting count as the `connect` stage,
+        the handshake as `tls` (see `submit.stats`); the time spent on a
+        relay which fails is counted as `connect_failed`."""
+        c = self.config
+        hosts = c.get_method(str, self.method, "host", "")
+        port = c.get_method(int, self.method, "port", default_port)
+        timeout = c.get_method(float, self.method, "timeout", DEFAULT_TIMEOUT)
+        data_timeout = c.get_method(float, self.method, "data_timeout",
+                DEFAULT_DATA_TIMEOUT)
+
+        handshake_error = None  # set while all relays failed that way
+        for relay in relay_health.order(parse_relays(hosts, port)):
+            self.host, self.port = relay
+            sock = None
+            connect, tls = Stopwatch(), Stopwatch()
+            try:
+                with connect:
+                    sock = open_connection(self.host, self.port, timeout)
+                conn = sock
+                if handshake is not None:
+                    with tls:
+                        conn = handshake(sock)
+                with connect:
+                    start(conn)
+            except (socket.error, smtplib.SMTPException) + tuple(errors), e:
+                record("connect_failed", connect.elapsed + tls.elapsed,
+                        self.timings)
+                relay_health.failed(relay)
+                if sock is not None:
+                    sock.close()
+                if not isinstance(e, tuple(errors)):
+                    handshake_error = False
+                elif handshake_error is not False:
+                    handshake_error = sys.exc_info()
+                continue
+            except:
+                exc_info = sys.exc_info()
+                record("connect_failed", connect.elapsed + tls.elapsed,
+                        self.timings)
+                if sock is not None:
+                    sock.close()
+                raise exc_info[0], exc_info[1], exc_info[2]
+            record("connect", connect.elapsed, self.timings)
+            if handshake is not None:
+                record("tls", tls.elapsed, self.timings)
+            relay_health.succeeded(relay)
+            self.conn.data_timeout = data_timeout
+            return
+        if handshake_error:
+            raise handshake_error[0], handshake_error[1], handshake_error[2]
+        raise ConnectionFailedError(
+                n_("Unable to open connection to %(host)s."), host=hosts)
 
     def ehlo(self):
         """Say hello to the SMTP server."""
         self.conn.ehlo(self.config.get_method(str, self.method,
-            "ehlo", default_mailname))
+            "ehlo", get_mailname))
+
+    def get_ssl_context(self, auth, method):
+        """Return an SSL context for the given method (see
+        `init_ssl_context`) and the dictionary of TLS sessions established
+        with it.  Both are taken from the `TLSCache` if possible."""
+        key = (self.method, method, self.config.get_method_items(self.method))
+        validity = self.get_tls_files_status()
+        if self.config.get_method(str, self.method, "key"):
+            # the private key may have been decrypted with a passphrase
+            # which has since been forgotten
+            validity += (auth.store.generation,)
+        cached = tls_cache.get(key, validity)
+        if cached is not None:
+            return cached
+        return tls_cache.put(key, validity,
+                self.init_ssl_context(auth, method))
+
+    def get_tls_files_status(self):
+        """Return the status of the files SSL contexts are loaded from, so
+        that changes can be detected."""
+        status = ()
+        for option in ("ca", "cert", "key"):
+            filename = self.config.get_method(str, self.method, option)
+            if not filename: continue
+            try:
+                st = os.stat(self.config.path(filename))
+                status += ((st.st_ino, st.st_size, st.st_mtime),)
+            except OSError:
+                status += (None,)
+        return status
 
     def init_ssl_context(self, auth, method):
         """Create an SSL context for the given method
         (`openssl.SSL.*_METHOD`), using the settings from the configuration
         file."""
+        from OpenSSL import SSL
         c = self.config
 
         ca = c.get_method(str, self.method, "ca")
@@ -135,19 +340,23 @@ class SMTPDeliverer(AbstractDeliverer):
 
     def tls_setup(self, auth):
         """Start transport layer security on the connection to the SMTP server."""
-        cx = self.init_ssl_context(auth, SSL.TLSv1_METHOD)
+        from OpenSSL import crypto, SSL
+        cx, sessions = self.get_ssl_context(auth, SSL.TLSv1_METHOD)
+        address = (self.host, self.port)
         try:
-            self.conn.starttls(cx)
+            self.conn.starttls(cx, sessions.get(address))
+            remember_session(self.conn.sock, sessions, address)
         except (SSL.Error, crypto.Error), e:
             raise AuthenticationFailedError(
                     n_("Error while trying to establish an encrypted "
                     "connection to %(host)s: %(details)s."),
-                    host=self.host, details=e.message[0][2])
+                    host=self.host, details=ssl_error_details(e))
         self.ehlo()
 
     def load_private_key(self, auth, key):
         """Load a private key file.  If necessary, ask for a passphrase until
         the correct one was specified by the user."""
+        from OpenSSL import crypto, SSL
         try:
             source = self.config.file(key).read()
         except IOError, e:
@@ -205,6 +414,28 @@ class SMTPDeliverer(AbstractDeliverer):
                 raise AuthenticationFailedError(
                         n_("Could not find a suitable SMTP authentication mechanism."))
 
+    def fan_out(self, rcpts):
+        """Spread the transactions of up to `max_rcpts` recipients each
+        (see `deliver`) over at most `connections` connections.  Each
+        connection gets a contiguous run of whole transactions."""
+        connections = self.config.get_method(int, self.method,
+                "connections", 1)
+        batches = self.batches(rcpts)
+        if connections <= 1 or len(batches) <= 1:
+            return [rcpts]
+        per_connection = -(-len(batches) // connections)
+        return [sum(batches[start:start + per_connection], [])
+                for start in xrange(0, len(batches), per_connection)]
+
+    def batches(self, rcpts):
+        """Split `rcpts` into lists of at most `max_rcpts` recipients."""
+        size = self.config.get_method(int, self.method, "max_rcpts",
+                DEFAULT_MAX_RCPTS)
+        if size <= 0 or len(rcpts) <= size:
+            return [rcpts]
+        return [rcpts[start:start + size]
+                for start in xrange(0, len(rcpts), size)]
+
     def abort(self):
         """Close the connection after the authentication procedure."""
         try:
@@ -213,30 +444,280 @@ class SMTPDeliverer(AbstractDeliverer):
             pass    # ignore it, we are aborting anyway
 
     def deliver(self, message, rcpts):
-        """Transmit the message."""
-
-        def err(result):
-            if 200 <= result[0] < 300: return
-            raise DeliveryFailedError(
-                    n_("SMTP transmission failed with error code %(code)d: %(details)s."),
-                    code=result[0], details=result[1])
-
+        """Transmit the message, starting a new transaction after every
+        `max_rcpts` recipients.  If the server supports it, the commands
+        are pipelined and the message is sent using BDAT; this can be
+        switched off using the `pipelining` and `chunking` options.
+
+        If a transaction fails after earlier ones have succeeded, the
+        `DeliveryError` raised names the recipients which have not received
+        the message in its `rcpts` attribute."""
+        pipelining = self.conn.has_extn("pipelining") and \
+                self.config.get_method(bool, self.method, "pipelining", True)
+        chunking = self.conn.has_extn("chunking") and \
+                self.config.get_method(bool, self.method, "chunking", True)
+        delivered = 0   # recipients of the successful transactions
         try:
-            err(self.conn.mail(message.efrom))
-            for rcpt in rcpts:
-                err(self.conn.rcpt(rcpt))
-            err(self.conn.data(message.get_body()))
-            self.close()
-
-        except (socket.error, smtplib.SMTPException), e:
-            raise DeliveryFailedError(
-                    n_("Error while talking to %(host)s: %(details)s"),
-                    host=self.host, details=str(e))
+            try:
+                options = self.mail_options(message)
+                for batch in self.batches(rcpts):
+                    if pipelining:
+                        self.deliver_pipelined(message, batch, options,
+                                chunking)
+                    else:
+                        self.deliver_sequential(message, batch, options,
+                                chunking)
+                    delivered += len(batch)
+
+            except (socket.error, smtplib.SMTPException), e:
+                if is_temporary(e):
+                    error = DeliveryDeferredError
+                else:
+                    error = DeliveryFailedError
+                raise error(n_("Error while talking to %(host)s: "
+                    "%(details)s"), host=self.host, details=str(e))
+        except DeliveryError, e:
+            if not delivered: raise
+            # the batches are contiguous runs of `rcpts`
+            error = e.__class__(n_("The message has been delivered to "
+                "%(delivered)d recipients, but not to %(rcpts)s: "
+                "%(details)s"), delivered=delivered,
+                rcpts=", ".join(rcpts[delivered:]), details=str(e))
+            error.rcpts = rcpts[delivered:]
+            raise error
+
+    def mail_options(self, message):
+        """Return the ESMTP parameters of the MAIL command: the size of the
+        message (RFC 1870) and its body type (RFC 6152), as far as the
+        server supports them.  If the message exceeds the maximum size
+        announced by the server, fail without transmitting anything."""
+        options = []
+        if self.conn.has_extn("size"):
+            size = message.get_crlf_size()
+            limit = self.conn.esmtp_features["size"].strip()
+            if limit.isdigit() and 0 < int(limit) < size:
+                raise DeliveryFailedError(n_("The message is too large for "
+                    "%(host)s (%(size)d bytes; at most %(limit)s are "
+                    "accepted)."), host=self.host, size=size, limit=limit)
+            options.append("SIZE=%d" % size)
+        if self.conn.has_extn("8bitmime"):
+            options.append("BODY=8BITMIME")
+        return options
+
+    def deliver_sequential(self, message, rcpts, options, chunking):
+        """Transmit the message in one transaction, waiting for the reply
+        to each command (see `deliver_pipelined` for the parameters)."""
+        check_reply(self.conn.mail(message.efrom, options), self.replies)
+        for rcpt in rcpts:
+            check_reply(self.conn.rcpt(rcpt), self.replies)
+        if chunking:
+            check_reply(self.conn.bdat_lines(message.lines()), self.replies)
+        else:
+            check_reply(self.conn.data_lines(message.lines()), self.replies)
+
+    def deliver_pipelined(self, message, rcpts, options, chunking):
+        """Transmit the message, sending MAIL, RCPT and (unless `chunking`
+        is true, see `SMTP.bdat_lines`) DATA in groups of `PIPELINE_GROUP`
+        commands and reading the replies of a group at once.  `options`
+        are the parameters of the MAIL command."""
+        mail = "mail FROM:%s" % smtplib.quoteaddr(message.efrom)
+        if options:
+            mail += " " + " ".join(options)
+        commands = [mail]
+        commands += ["rcpt TO:%s" % smtplib.quoteaddr(rcpt) for rcpt in rcpts]
+        if not chunking:
+            commands.append("DATA")
+        replies = []
+        for start in xrange(0, len(commands), PIPELINE_GROUP):
+            replies += self.conn.pipeline(
+                    commands[start:start + PIPELINE_GROUP])
+
+        if chunking:
+            for reply in replies:
+                check_reply(reply, self.replies)
+            check_reply(self.conn.bdat_lines(message.lines(), BDAT_WINDOW),
+                    self.replies)
+            return
+
+        data = replies.pop()
+        try:
+            for reply in replies:
+                check_reply(reply, self.replies)
+        except DeliveryError:
+            if data[0] == 354:
+                # the server expects the message now; the only way to abort
+                # the transaction is to drop the connection
+                self.conn.close()
+            raise
+        self.replies.append(data[0])
+        if data[0] != 354:
+            raise smtplib.SMTPDataError(*data)
+        check_reply(self.conn.send_lines(message.lines()), self.replies)
 
     def close(self):
-        """Close the connection."""
-        self.conn.quit()
+        """Close the connection.  The message is out at this point, so
+        errors are ignored."""
+        try:
+            self.conn.quit()
+        except (socket.error, smtplib.SMTPException):
+            pass
+
+    def pool_key(self):
+        """SMTP connections can be shared between deliveries using the same
+        configuration of the delivery method."""
+        return (self.__class__, self.method,
+                self.config.get_method_items(self.method))
+
+    def reset(self):
+        """Abort any pending transaction on a pooled connection."""
+        try:
+            return self.conn.rset()[0] == 250
+        except (socket.error, smtplib.SMTPException):
+            return False
+
+    def ping(self):
+        """Send a NOOP to check the connection."""
+        try:
+            return self.conn.noop()[0] == 250
+        except (socket.error, smtplib.SMTPException):
+            return False
 
 Deliverer = SMTPDeliverer
 
+class TLSCache:
+    """SSL contexts shared by all deliveries of a process (which matters
+    for the daemon process), together with the TLS sessions established
+    using them.  Creating a context is expensive, as the CA file is read and
+    the private key decrypted.  A context is reused as long as the
+    configuration of its delivery method and the validity information
+    passed in by the caller stay the same."""
+
+    def __init__(self):
+        """Create an empty cache."""
+        self.entries = {}   # key: (validity, context, {address: session})
+        self.lock = threading.Lock()
+
+    def get(self, key, validity):
+        """Return the (context, sessions) tuple cached as `key`, or `None`
+        if there is none or if it was stored with a different `validity`."""
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or entry[0] != validity:
+            return None
+        return entry[1:]
+
+    def put(self, key, validity, context):
+        """Cache `context` as `key` and return the (context, sessions)
+        tuple."""
+        entry = (validity, context, {})
+        with self.lock:
+            self.entries[key] = entry
+        return entry[1:]
+
+tls_cache = TLSCache()
+
+def resume_session(conn, session):
+    """Ask the SSL connection `conn` to resume `session` (if it is not
+    `None`).  This requires pyOpenSSL 0.14; with older versions, a full
+    handshake is done."""
+    from OpenSSL import SSL
+    if session is None: return
+    try:
+        conn.set_session(session)
+    except (AttributeError, SSL.Error):
+        pass
+
+def tls_handshake(conn, sock):
+    """Do the handshake of the SSL connection `conn` on the socket `sock`,
+    taking at most as long as the timeout of `sock`; `socket.timeout` is
+    raised after that.  pyOpenSSL cannot deal with socket timeouts, so the
+    socket is put into non-blocking mode for the handshake and blocks
+    (without a timeout) afterwards."""
+    from OpenSSL import SSL
+    timeout = sock.gettimeout()
+    if timeout is not None:
+        deadline = monotonic() + timeout
+    sock.setblocking(False)
+    while True:
+        try:
+            conn.do_handshake()
+            break
+        except SSL.WantReadError:
+            rlist, wlist = [sock], []
+        except SSL.WantWriteError:
+            rlist, wlist = [], [sock]
+        if timeout is None:
+            select.select(rlist, wlist, [])
+            continue
+        remaining = deadline - monotonic()
+        if remaining <= 0 or select.select(rlist, wlist, [],
+                remaining) == ([], [], []):
+            raise socket.timeout("timed out")
+    sock.setblocking(True)
+
+def ssl_error_details(e):
+    """Return the reason given by the pyOpenSSL exception `e`.  Errors of
+    the OpenSSL library come with a list of (library, function, reason)
+    tuples; others, such as a `SysCallError`, are simply converted to a
+    string."""
+    try:
+        return e.args[0][0][2]
+    except (IndexError, TypeError):
+        return str(e)
+
+def remember_session(conn, sessions, address):
+    """Store the session of the SSL connection `conn` with the server at
+    `address` in the dictionary `sessions`, so that it can be resumed
+    later."""
+    try:
+        session = conn.get_session()
+    except AttributeError:
+        return
+    if session is not None:
+        sessions[address] = session
+
+def crlf_chunks(lines, stuff_dots = False):
+    """Join the `lines` of a message into strings of about
+    `DATA_BUFFER_SIZE` bytes, converting line endings to CRLF.  If
+    `stuff_dots` is true, leading periods are doubled.  The last string
+    may be empty."""
+    buf = []
+    size = 0
+    for line in lines:
+        if line.endswith("\r\n"): line = line[:-2]
+        elif line.endswith("\n"): line = line[:-1]
+        if stuff_dots and line.startswith("."): line = "." + line
+        buf.append(line)
+        buf.append(smtplib.CRLF)
+        size += len(line) + 2
+        if size >= DATA_BUFFER_SIZE:
+            yield "".join(buf)
+            buf = []
+            size = 0
+    yield "".join(buf)
+
+def check_reply(reply, replies = None):
+    """Raise a `DeliveryError` if the (code, message) `reply` of an SMTP
+    server does not indicate success.  The code is appended to the list
+    `replies`, if given."""
+    if replies is not None:
+        replies.append(reply[0])
+    if 200 <= reply[0] < 300: return
+    if 400 <= reply[0] < 500:
+        error = DeliveryDeferredError
+    else:
+        error = DeliveryFailedError
+    raise error(
+            n_("SMTP transmission failed with error code %(code)d: %(details)s."),
+            code=reply[0], details=reply[1])
+
+def is_temporary(error):
+    """Determine whether the `error` raised while talking to an SMTP server
+    might go away when trying again later: network problems and 4xx
+    replies."""
+    if isinstance(error, (socket.error, smtplib.SMTPServerDisconnected)):
+        return True
+    code = getattr(error, "smtp_code", None)
+    return code is not None and 400 <= code < 500
+
 # vim:tw=78:fo-=t:sw=4:sts=4:et:
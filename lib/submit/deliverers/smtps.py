@@ -11,9 +11,9 @@
 from submit.i18n import *
 from submit.deliverers.smtp import *
 from submit.errors import *
+from submit.hostinfo import *
 import smtplib
 import socket
-from OpenSSL import crypto, SSL
 
 __all__ = ["SMTPSDeliverer"]
 
@@ -24,34 +24,44 @@ class SMTPSDeliverer(SMTPDeliverer):
 
     def authenticate(self, auth):
         """Open a connection to an SMTPS server."""
-        c = self.config
+        from OpenSSL import crypto, SSL
+        # until a relay has been picked, errors refer to all of them
+        self.host = self.config.get_method(str, self.method, "host")
+
+        def handshake(sock):
+            ssl = SSL.Connection(cx, sock)
+            resume_session(ssl, sessions.get((self.host, self.port)))
+            ssl.set_connect_state()
+            tls_handshake(ssl, sock)
+            return ssl
+
+        def start(ssl):
+            self.conn = SMTP(local_hostname=get_fqdn())
+            self.conn.attach(ssl, smtplib.SSLFakeFile(ssl))
 
-        self.host = host = c.get_method(str, self.method, "host")
-        port = c.get_method(int, self.method, "port", SMTPS_PORT)
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            ssl = SSL.Connection(self.init_ssl_context(auth, SSL.SSLv23_METHOD),
-                    sock)
-            ssl.connect((host, port))
-            conn = self.conn = smtplib.SMTP()
-            conn.sock = ssl
-            conn.file = smtplib.SSLFakeFile(ssl)
+            cx, sessions = self.get_ssl_context(auth, SSL.SSLv23_METHOD)
+            # a connection which breaks down during the handshake only rules
+            # out this relay, but one which cannot be trusted is fatal
+            self.connect(SMTPS_PORT, start, handshake,
+                    (SSL.SysCallError, SSL.ZeroReturnError))
         except (SSL.Error, crypto.Error), e:
             raise AuthenticationFailedError(
                     n_("Error while trying to establish an encrypted "
                     "connection to %(host)s: %(details)s."),
-                    host=self.host, details=e.message[0][2])
-        except (socket.error, IOError, smtplib.SMTPException), e:
-            raise AuthenticationFailedError(
-                    n_("Unable to open connection to %(host)s."), host=host)
+                    host=self.host, details=ssl_error_details(e))
 
         try:
             self.ehlo()
+            remember_session(self.conn.sock, sessions, (self.host, self.port))
             self.sasl_auth(auth)
         except (socket.error, smtplib.SMTPException), e:
-            raise AuthenticationFailedError(
-                    n_("Error while talking to %(host)s: %(details)s"),
-                    host=host, details=str(e))
+            if is_temporary(e):
+                error = ConnectionFailedError
+            else:
+                error = AuthenticationFailedError
+            raise error(n_("Error while talking to %(host)s: %(details)s"),
+                    host=self.host, details=str(e))
 
 Deliverer = SMTPSDeliverer
 
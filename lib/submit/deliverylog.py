@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of submit, a sendmail replacement or supplement for
+# multi-user desktop systems.
+#
+# Copyright © 2008 Michael Schutte <michi@uiae.at>
+#
+# submit is available under the terms of the MIT/X license.  Please see the
+# file COPYING for details.
+
+from __future__ import with_statement
+from submit.errors import *
+from submit.i18n import *
+import json
+import os
+import threading
+import time
+import Queue
+
+__all__ = ["DeliveryLog"]
+
+DEFAULT_MAX_SIZE = 10240    # kilobytes before the log is rotated
+DEFAULT_KEEP = 5            # rotated logs kept
+QUEUE_SIZE = 4096           # records waiting to be written
+CLOSE_TIMEOUT = 5           # seconds to wait for the writer when closing
+
+class DeliveryLog:
+    """A file to which the daemon process appends one line of JSON per
+    message.  Records are handed to a background thread, which encodes and
+    writes everything that has accumulated at once, so a delivery thread
+    never waits for the disk.  If the writer cannot keep up, records are
+    dropped and their number is logged instead.  When the file has grown
+    beyond `max_size` bytes, it is renamed to `path.1` (and `path.1` to
+    `path.2` and so on, keeping `keep` old files) and a new one is
+    started."""
+
+    def __init__(self, path, max_size = DEFAULT_MAX_SIZE * 1024,
+            keep = DEFAULT_KEEP):
+        """Log to the file `path`, which is created if necessary."""
+        self.path = path
+        self.max_size = max_size
+        self.keep = keep
+        self.queue = Queue.Queue(QUEUE_SIZE)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.writer = threading.Thread(target=self.run)
+        self.writer.setDaemon(True)
+        self.writer.start()
+
+    def configure(self, config):
+        """Take the size limit and the number of old logs to keep from the
+        `general.delivery_log_size` (in kilobytes) and
+        `general.delivery_log_keep` options.  Raise a `ConfigError` if they
+        are not numbers."""
+        try:
+            self.max_size = 1024 * config.get_general(int,
+                    "delivery_log_size", DEFAULT_MAX_SIZE)
+            self.keep = config.get_general(int, "delivery_log_keep",
+                    DEFAULT_KEEP)
+        except ValueError, e:
+            raise ConfigError(n_("Invalid delivery log setting: "
+                "%(details)s."), details=str(e))
+
+    def write(self, record):
+        """Queue the dictionary `record` for writing; it must consist of
+        types JSON can represent."""
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def close(self):
+        """Write the queued records and stop the writer thread, waiting for
+        at most `CLOSE_TIMEOUT` seconds (each) for room in the queue and for
+        the writer to finish."""
+        try:
+            self.queue.put(None, True, CLOSE_TIMEOUT)
+        except Queue.Full:
+            return
+        self.writer.join(CLOSE_TIMEOUT)
+
+    def run(self):
+        """Main function of the writer thread."""
+        fout = None
+        while True:
+            records = [self.queue.get()]
+            try:
+                while True:
+                    records.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            closing = None in records
+            lines = []
+            with self.lock:
+                dropped, self.dropped = self.dropped, 0
+            for record in records:
+                if record is None: continue
+                try:
+                    lines.append(encode(record) + "\n")
+                except (TypeError, ValueError):
+                    # not representable in JSON; don’t let it stop the log
+                    dropped += 1
+            if dropped:
+                lines.append(encode(dict(time=time.time(),
+                    dropped=dropped)) + "\n")
+            try:
+                if lines:
+                    if fout is None:
+                        fout = open(self.path, "a")
+                    fout.write("".join(lines))
+                    fout.flush()
+                    if fout.tell() >= self.max_size:
+                        fout.close()
+                        fout = None
+                        self.rotate()
+            except (IOError, OSError):
+                # the directory may have gone; try again with the next batch
+                if fout is not None:
+                    fout.close()
+                    fout = None
+            if closing:
+                if fout is not None:
+                    fout.close()
+                return
+
+    def rotate(self):
+        """Shift the old logs by one and make the current one the first."""
+        if self.keep < 1:
+            os.remove(self.path)
+            return
+        for index in xrange(self.keep - 1, 0, -1):
+            name = "%s.%d" % (self.path, index)
+            if os.path.exists(name):
+                os.rename(name, "%s.%d" % (self.path, index + 1))
+        os.rename(self.path, self.path + ".1")
+
+def encode(record):
+    """Encode `record` as JSON.  Strings are assumed to be UTF-8; as
+    headers and error messages may be in any encoding, Latin-1 is tried if
+    that fails."""
+    try:
+        return json.dumps(record)
+    except UnicodeDecodeError:
+        return json.dumps(record, encoding="latin-1")
+
+# vim:tw=78:fo-=t:sw=4:sts=4:et:
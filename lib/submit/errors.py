@@ -22,15 +22,29 @@ class UserError(Exception):
     def __str__(self):
         return self.message % self.params
 
+class TemporaryFailure:
+    """Mixed into errors which may go away if the operation is tried again
+    later, such as network problems or 4xx replies of SMTP servers."""
+
 class DeliveryError(UserError):
-    """Something went wrong in the delivery process."""
+    """Something went wrong in the delivery process.  If the message has
+    reached some of the recipients, `rcpts` lists the remaining ones."""
+
+    rcpts = None
 
 class AuthenticationFailedError(DeliveryError):
     """The authentication process failed."""
 
+class ConnectionFailedError(AuthenticationFailedError, TemporaryFailure):
+    """The connection to the server could not be established or was
+    lost."""
+
 class DeliveryFailedError(DeliveryError):
     """The message submission failed."""
 
+class DeliveryDeferredError(DeliveryFailedError, TemporaryFailure):
+    """The message submission failed for the moment."""
+
 class ConfigError(UserError):
     """The user made a mistake in the configuration file."""
 
@@ -9,24 +9,25 @@
 # file COPYING for details.
 
 from submit import *
-from submit.auth import *
 from submit.channel import *
-from submit.config import *
-from submit.daemon import *
 from submit.errors import *
 from submit.i18n import *
-from submit.message import *
 from submit.ui import *
-from cStringIO import StringIO
 import sys
 import os
+import socket
+import time
 import traceback
 
 __all__ =  ["Frontend"]
 
 class Frontend:
     """The submit frontend.  It either delivers mails on its own or starts and
-    communicates with the daemon process to do so."""
+    communicates with the daemon process to do so.
+
+    As submit is started once per message, modules which take long to load
+    (the email package, the daemon, user interfaces) are only imported when
+    they are actually needed."""
 
     def __init__(self, usage):
         """Create a new frontend instance."""
@@ -35,7 +36,9 @@ class Frontend:
 
         self.daemon_only = False
         self.shutdown = False
+        self.stats = False
         self.unlock_method = None
+        self.batch = None
         self.config_location = None
         self.envelope_from = None
         self.period_eof = True
@@ -44,21 +47,35 @@ class Frontend:
 
         self.channel = None
         self.ui = None
+        self.ui_ready = False
 
     def run(self):
         """Parse command line options, read the message and submit it.  This
         method does not return."""
         self.getopt()
-        self.config = Config(self.config_location)
 
+        # if the daemon is running, simply pass the message on; the daemon
+        # parses and routes it, so the configuration isn’t even loaded here
+        # unless the user has to be asked for a password
+        if not (self.shutdown or self.stats or self.daemon_only or
+                self.unlock_method) and self.connect_thin():
+            if self.batch:
+                self.deliver_batch()
+            if not self.deliver_daemon(self.read_message()):
+                sys.exit(1)
+            sys.exit(0)
+
+        config = self.get_config()
         if self.shutdown:
             if self.connect():
                 self.channel.send(ShutdownRequest())
             sys.exit(0)
+        if self.stats:
+            self.show_stats()
 
-        self.setup_ui()
-
-        force_daemon = self.config.get_general(bool, "force_daemon", False)
+        # only the daemon process can spool messages
+        force_daemon = config.get_general(bool, "force_daemon", False) or \
+                bool(config.get_general(str, "spool"))
         if not self.connect() and force_daemon:
             self.fork_daemon()
             self.connect()
@@ -73,11 +90,16 @@ class Frontend:
 
         # --unlock: ask for some passwords, then quit
         elif self.unlock_method:
+            from submit.auth import UnlockRequest
             method = self.unlock_method
             if method == "all": method = None
             if not self.deliver(UnlockRequest(method)):
                 sys.exit(1)
 
+        # --batch: deliver a bunch of messages through the daemon
+        elif self.batch:
+            self.deliver_batch()
+
         # normal mode of operation: read a message and send it
         else:
             msg = self.read_message()
@@ -115,8 +137,12 @@ class Frontend:
                     self.daemon_only = True
                 elif opt == "--unlock":
                     self.unlock_method = args.pop(0)
+                elif opt == "--batch":
+                    self.batch = args.pop(0)
                 elif opt == "--shutdown":
                     self.shutdown = True
+                elif opt == "--stats":
+                    self.stats = True
                 elif opt[:2] == "-C":
                     self.config_location = get_arg(opt)
                 elif opt[:2] in ("-f", "-r"):
@@ -164,10 +190,17 @@ class Frontend:
         if addarg: args.insert(0, addarg)
         os.execl(program, "sendmail", *args)
 
+    def get_config(self):
+        """Return the configuration, loading it on first use."""
+        if self.config is None:
+            from submit.config import Config
+            self.config = Config(self.config_location)
+        return self.config
+
     def setup_ui(self):
         """Find a suitable user interface for password queries and error
         messages."""
-        uinames = self.config.get_general(str, "ui", "gnome,gtk,tty")
+        uinames = self.get_config().get_general(str, "ui", "gnome,gtk,tty")
         for uiname in uinames.split(","):
             uiname = uiname.strip() + "_ui"
             try:
@@ -181,6 +214,31 @@ class Frontend:
             break
         if self.ui: self.ui.prepare()
 
+    def get_ui(self):
+        """Return the user interface, setting it up on first use, or `None`
+        if there is no usable interface."""
+        if not self.ui_ready:
+            self.ui_ready = True
+            self.setup_ui()
+        return self.ui
+
+    def connect_thin(self):
+        """Connect to the daemon socket at its default location without
+        loading the configuration.  Return false if there is no daemon or if
+        it is of a different version; the caller should fall back to
+        `connect` then."""
+        filename = Channel.get_default_path(self.config_location)
+        try:
+            channel = Channel.connect_path(filename)
+            request = channel.receive()
+        except (ChannelError, EOFError):
+            return False
+        if request.version != SUBMIT_VERSION:
+            channel.close()
+            return False
+        self.channel = channel
+        return True
+
     def connect(self):
         """Establish a connection with the daemon socket, if available."""
         try:
@@ -203,47 +261,79 @@ check your installation."""
             self.channel = None
             return False
 
+    def show_stats(self):
+        """Print the time the daemon process has spent in each stage of
+        message submission.  This method does not return."""
+        from submit.stats import StatsRequest
+        if not self.connect():
+            print >>sys.stderr, _("The daemon process is not running.")
+            sys.exit(1)
+        self.channel.send(StatsRequest())
+        report = self.channel.receive()
+        while isinstance(report, QueueStatus):
+            # the daemon is busy; our turn will come
+            report = self.channel.receive()
+        print "%-14s %8s %10s %10s %10s %10s" % (_("stage"), _("count"),
+                _("mean"), _("median"), _("99%"), _("max"))
+        for stage, histogram in sorted(report.histograms.items()):
+            print "%-14s %8d %8.1fms %8.1fms %8.1fms %8.1fms" % (stage,
+                    histogram.count,
+                    1000 * histogram.sum / max(histogram.count, 1),
+                    1000 * histogram.quantile(0.5),
+                    1000 * histogram.quantile(0.99),
+                    1000 * histogram.max)
+        sys.exit(0)
+
     def fork_daemon(self):
         """Start the daemon process."""
         if self.channel: return     # there already is a connection to the daemon
-        sockfile = self.config.path(self.config.get_general(str, "socket", "socket"))
-        daemon = Daemon(self.config, sockfile)
+        from submit.daemon import Daemon
+        daemon = Daemon(self.config, Channel.get_path(self.config))
         daemon.run()
 
     def read_message(self):
-        """Read the message from stdin."""
-        body = StringIO()
-        while True:
-            try:
-                line = sys.stdin.readline()
-            except KeyboardInterrupt:
-                sys.exit(1)
-            if line == "": break
-            if line.rstrip("\r\n") == "." and self.period_eof: break
-            body.write(line)
-        body = body.getvalue()
-        return Message(self.config, body, self.recipients, self.parse_rcpts,
-                self.envelope_from)
+        """Read the message from stdin.  If there is a connection to the
+        daemon, the message is left for the daemon to parse and a
+        `RawMessage` is returned; otherwise, a `Message`."""
+        from submit.body import spool_message
+        # the monotonic clock of submit.stats is too expensive to load here;
+        # a jump of the wall clock at worst spoils a single measurement
+        start = time.time()
+        try:
+            header, body = spool_message(sys.stdin, self.period_eof)
+        except KeyboardInterrupt:
+            sys.exit(1)
+        if self.channel:
+            return RawMessage(header, body, self.recipients,
+                    self.parse_rcpts, self.envelope_from,
+                    max(time.time() - start, 0.0))
+        from submit.message import Message
+        return Message(self.config, header, body, self.recipients,
+                self.parse_rcpts, self.envelope_from)
 
     def deliver(self, message):
         """Try to send the given message by either communicating with the
         daemon process or by directly sending it.  `message` can also be an
         `UnlockRequest` if the user has requested to authenticate without
         sending a message."""
+        from submit.auth import UnlockRequest
         if not self.channel:
             use_daemon = False
             deliverers = message.create_deliverers(self.config)
-            # if the chosen UI does not store passwords itself and at least
-            # one deliverer is likely to ask for a password, better launch and
-            # use the daemon
-            if not self.ui or not self.ui.stores_passwords():
-                if isinstance(message, UnlockRequest):
-                    use_daemon = True
-                else:
-                    for deliverer, rcpts in deliverers:
-                        if deliverer.needs_authentication():
-                            use_daemon = True
-                            break
+            # if at least one deliverer is likely to ask for a password and
+            # the chosen UI does not store passwords itself, better launch
+            # and use the daemon; don’t set up the UI otherwise
+            if isinstance(message, UnlockRequest):
+                needs_password = True
+            else:
+                needs_password = False
+                for deliverer, rcpts in deliverers:
+                    if deliverer.needs_authentication():
+                        needs_password = True
+                        break
+            if needs_password:
+                ui = self.get_ui()
+                use_daemon = not ui or not ui.stores_passwords()
         else:
             use_daemon = True
         if use_daemon:
@@ -253,26 +343,75 @@ check your installation."""
 
     def deliver_daemon(self, message):
         """Use the daemon process to deliver `message`."""
+        self.open_session()
+        return self.exchange(message)
+
+    def deliver_batch(self):
+        """Deliver the messages given with `--batch` one after another
+        through a single connection to the daemon process, which keeps the
+        connections to the servers open in between.  If no recipients have
+        been given on the command line, they are taken from the headers of
+        each message.  This method does not return."""
+        from submit.batch import read_batch
+        self.open_session()
+        parse_rcpts = self.parse_rcpts or not self.recipients
+        requested = True
+        failed = False
+        try:
+            for header, body in read_batch(self.batch):
+                message = RawMessage(header, body, self.recipients,
+                        parse_rcpts, self.envelope_from)
+                if not self.exchange(message, requested):
+                    failed = True
+                requested = False
+        except (IOError, ValueError), e:
+            print >>sys.stderr, _("Unable to read the batch: %(details)s") % \
+                    dict(details=str(e))
+            failed = True
+        except (EOFError, socket.error):
+            print >>sys.stderr, _("The daemon process has closed the "
+                    "connection.")
+            sys.exit(1)
+        self.channel.send(CloseRequest())
+        if failed:
+            sys.exit(1)
+        sys.exit(0)
+
+    def open_session(self):
+        """Connect to the daemon process, starting it if necessary, and tell
+        it which configuration to use."""
         if not self.channel:
             self.fork_daemon()
             self.connect()
 
+        confdir = self.config_location
+        if confdir: confdir = os.path.abspath(confdir)
+        self.channel.send(ConfigLocation(confdir))
+
+    def send_message(self, message):
+        """Send `message` to the daemon process."""
+        body = getattr(message, "body", None)
+        if body is not None:
+            # large bodies already are in a temporary file; offer the
+            # daemon to read them from there
+            self.channel.send(message, body, body.in_file())
+        else:
+            self.channel.send(message)
+
+    def exchange(self, message, requested = True):
+        """Transfer `message` to the daemon process and answer its requests
+        until the delivery is done.  Return true if it has succeeded.  If
+        `requested` is false, `message` is sent right away instead of in
+        response to a `MessageRequest`, which is how all but the first
+        message of a batch are transferred."""
         ch = self.channel
         broken = False
-        ch.send(self.config)
+        if not requested:
+            self.send_message(message)
         while True:
             request = ch.receive()
             if isinstance(request, MessageRequest):
-                ch.send(message)
-            elif isinstance(request, PasswordRequest):
-                try:
-                    password = self.ask_password(
-                            request.method, request.key,
-                            request.query, request.first)
-                except InterfaceError:
-                    broken = True
-                    password = None
-                ch.send(request.create_response(password))
+                self.send_message(message)
             elif isinstance(request, UserError):
                 if broken:
                     # the error says that delivery was aborted “on user
@@ -288,32 +427,69 @@ check your installation."""
                 return False
             elif isinstance(request, CloseRequest):
                 return True
+            elif isinstance(request, QueueStatus):
+                # the daemon is busy; our turn will come
+                continue
+            else:
+                # only password requests are left; receiving one has already
+                # loaded their module
+                from submit.auth import PasswordRequest
+                if not isinstance(request, PasswordRequest):
+                    continue
+                try:
+                    password = self.ask_password(
+                            request.method, request.key,
+                            request.query, request.first)
+                except InterfaceError:
+                    broken = True
+                    password = None
+                ch.send(request.create_response(password))
 
     def deliver_directly(self, message, deliverers):
         """Use the given deliverers to submit `message` directly (i.e.,
-        without using a daemon)."""
-        for deliverer, rcpts in deliverers:
-            store = PasswordStore(deliverer.method)
-            try:
+        without using a daemon).  All deliverers are authenticated first;
+        then the message is delivered through all of them at once."""
+        from submit.auth import PasswordStore, FrontendAuthenticator
+        from submit.deliverers import deliver_all
+        jobs = []
+        stores = {}     # method: PasswordStore
+        try:
+            for deliverer, rcpts in deliverers:
+                store = stores.get(deliverer.method)
+                if store is None:
+                    # several deliverers may share a method (see
+                    # `Config.create_deliverers`); ask only once
+                    store = stores[deliverer.method] = \
+                            PasswordStore(deliverer.method)
                 deliverer.authenticate(FrontendAuthenticator(store, self))
-                if self.unlock_method:
+                jobs.append((deliverer, rcpts))
+            if self.unlock_method:
+                for deliverer, rcpts in jobs:
                     deliverer.abort()
-                else:
-                    deliverer.deliver(message, rcpts)
-            except InterfaceError:
+            else:
+                deliver_all(message, jobs,
+                        lambda deliverer: deliverer.close())
+        except InterfaceError:
+            deliverer.abort()
+            for deliverer, rcpts in jobs:
                 deliverer.abort()
-                return False
-            except UserError, e:
+            return False
+        except UserError, e:
+            if len(jobs) < len(deliverers):
+                # authentication failed
                 deliverer.abort()
-                self.show_error(e)
-                return False
+                for deliverer, rcpts in jobs:
+                    deliverer.abort()
+            self.show_error(e)
+            return False
         return True
 
     def ask_password(self, method, key, query, first):
         """Ask the user for the specified password.  If no user interface is
         available, raise an `InterfaceError`."""
-        if self.ui:
-            return self.ui.ask_password(method, key, query, first)
+        ui = self.get_ui()
+        if ui:
+            return ui.ask_password(method, key, query, first)
         else:
             print >>sys.stderr, _("""\
 Mail submission has been cancelled because you have to supply a password, but
@@ -325,22 +501,10 @@ Please run "submit --unlock all" on another virtual terminal and try again.""")
 
     def show_error(self, error):
         """Show an error message."""
-        if self.ui:
-            self.ui.show_error(error)
+        ui = self.get_ui()
+        if ui:
+            ui.show_error(error)
         else:
             print >>sys.stderr, str(error)
 
-class FrontendAuthenticator(AbstractAuthenticator):
-    """An authenticator used as a daemonless provider of credentials.  It
-    directly passes on password requests to the frontend."""
-
-    def __init__(self, store, frontend):
-        """Create a new frontend authenticator."""
-        AbstractAuthenticator.__init__(self, store)
-        self.frontend = frontend
-
-    def query_password(self, key, query, first):
-        """Ask the user for a password."""
-        return self.frontend.ask_password(self.store.method, key, query, first)
-
 # vim:tw=78:fo-=t:sw=4:sts=4:et:
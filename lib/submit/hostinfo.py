@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of submit, a sendmail replacement or supplement for
+# multi-user desktop systems.
+#
+# Copyright © 2008 Michael Schutte <michi@uiae.at>
+#
+# submit is available under the terms of the MIT/X license.  Please see the
+# file COPYING for details.
+
+from __future__ import with_statement
+import socket
+import threading
+import time
+
+__all__ = ["get_hostname", "get_fqdn", "get_mailname"]
+
+HOST_TTL = 300          # seconds a looked-up name stays valid
+REFRESH_MARGIN = 60     # refresh names this many seconds before they expire
+
+class HostIdentity:
+    """The names of the local host.  Looking them up can be slow (`getfqdn`
+    does a reverse DNS lookup), so they are cached for `HOST_TTL` seconds.
+    There is one instance per process; use the module-level functions to
+    access it."""
+
+    def __init__(self):
+        """Create an empty cache."""
+        self.values = {}    # name: (value, lookup function, expiry time)
+        self.lock = threading.Lock()
+
+    def get(self, name, lookup):
+        """Return the cached value called `name`.  If it is missing or has
+        expired, call `lookup` to determine it."""
+        with self.lock:
+            entry = self.values.get(name)
+        if entry is not None and time.time() < entry[2]:
+            return entry[0]
+        return self.update(name, lookup)
+
+    def update(self, name, lookup):
+        """Look up `name` using `lookup` and cache the result."""
+        value = lookup()
+        with self.lock:
+            self.values[name] = (value, lookup, time.time() + HOST_TTL)
+        return value
+
+    def invalidate(self):
+        """Forget all cached names."""
+        with self.lock:
+            self.values.clear()
+
+    def refresh(self):
+        """Look up the cached names which are about to expire again, so that
+        they can be served from the cache without delay.  Long-running
+        processes should call this periodically."""
+        deadline = time.time() + REFRESH_MARGIN
+        with self.lock:
+            stale = [(name, entry[1]) for name, entry in self.values.items()
+                    if entry[2] < deadline]
+        for name, lookup in stale:
+            self.update(name, lookup)
+
+identity = HostIdentity()
+
+def get_hostname():
+    """Return the (cached) host name."""
+    return identity.get("hostname", socket.gethostname)
+
+def get_fqdn():
+    """Return the (cached) fully qualified domain name of the host."""
+    return identity.get("fqdn", socket.getfqdn)
+
+def read_mailname():
+    """Determine the default mailname by reading /etc/mailname or using the
+    fully qualified domain name of the host."""
+    fin = mailname = None
+    try:
+        fin = open("/etc/mailname")
+        mailname = fin.read().strip()
+    except IOError:
+        if fin: fin.close()
+
+    if not mailname:
+        return get_fqdn()
+    else:
+        return mailname
+
+def get_mailname():
+    """Return the (cached) default mailname."""
+    return identity.get("mailname", read_mailname)
+
+def invalidate():
+    """Forget all cached host names."""
+    identity.invalidate()
+
+def refresh():
+    """Refresh the cached host names which are about to expire."""
+    identity.refresh()
+
+# vim:tw=78:fo-=t:sw=4:sts=4:et:
@@ -8,32 +8,137 @@
 # submit is available under the terms of the MIT/X license.  Please see the
 # file COPYING for details.
 
+from submit.body import *
+from submit.hostinfo import *
 import os
 import pwd
-import socket
-import email
+import re
 import email.utils
-import email.parser
 
-__all__ = ["Message"]
+__all__ = ["Message", "MessageHeader"]
+
+# line breaks inside a folded header field
+FOLD_RE = re.compile(r"\r?\n(?=[ \t])")
+
+class MessageHeader:
+    """The header of a message.  It is kept as the text it was received as,
+    together with the offsets of each field in it, which are only determined
+    when a field is first looked up.  Nothing is decoded or re-folded:
+    fields which are not removed are written out exactly as they came in,
+    followed by the fields added later.  Field names are case-insensitive,
+    as in `email.message.Message`."""
+
+    def __init__(self, text):
+        """Wrap the header `text`, which does not include the empty line
+        separating it from the body."""
+        self.text = text
+        self.fields = None  # (lowercase name, start, end) tuples, see `parse`
+        self.added = []     # (lowercase name, text) tuples of new fields
+        self.string = None  # cached result of `as_string`
+
+    def parse(self):
+        """Locate the fields in the header text and return them as
+        (lowercase name, start offset, end offset) tuples.  Continuation
+        lines are part of the field they follow."""
+        if self.fields is not None:
+            return self.fields
+        fields = []
+        text = self.text
+        start = 0
+        while start < len(text):
+            end = text.find("\n", start) + 1 or len(text)
+            if text[start] in " \t" and fields:
+                name, first, last = fields[-1]
+                fields[-1] = (name, first, end)
+            else:
+                name = text[start:end].split(":", 1)[0].strip().lower()
+                fields.append((name, start, end))
+            start = end
+        self.fields = fields
+        return fields
+
+    def get_all(self, name, failobj = None):
+        """Return the unfolded values of all fields called `name`, or
+        `failobj` if there are none."""
+        name = name.lower()
+        values = [self.text[start:end] for field, start, end in self.parse()
+                if field == name]
+        values += [text for field, text in self.added if field == name]
+        if not values:
+            return failobj
+        return [unfold(value) for value in values]
+
+    def get(self, name, failobj = None):
+        """Return the value of the first field called `name`, or `failobj`
+        if there is none."""
+        values = self.get_all(name)
+        if not values:
+            return failobj
+        return values[0]
+
+    def has_key(self, name):
+        """Determine whether there is a field called `name`."""
+        return self.get_all(name) is not None
+
+    def __getitem__(self, name):
+        """Like `get`."""
+        return self.get(name)
+
+    def __setitem__(self, name, value):
+        """Add a field to the end of the header.  Existing fields of the
+        same name are kept."""
+        self.added.append((name.lower(), "%s: %s\n" % (name, value)))
+        self.string = None
+
+    def __delitem__(self, name):
+        """Remove all fields called `name`."""
+        name = name.lower()
+        self.fields = [field for field in self.parse() if field[0] != name]
+        self.added = [field for field in self.added if field[0] != name]
+        self.string = None
+
+    def as_string(self):
+        """Return the header including the empty line after it."""
+        if self.string is None:
+            text = self.text
+            parts = [text[start:end] for name, start, end in self.parse()]
+            if parts and not parts[-1].endswith("\n"):
+                # the last field lacked a line break
+                parts[-1] += "\n"
+            parts += [field for name, field in self.added]
+            parts.append("\n")
+            self.string = "".join(parts)
+        return self.string
+
+def unfold(field):
+    """Return the value of the header `field` (given with its name and line
+    breaks) on a single line."""
+    value = field.split(":", 1)[1:] or [""]
+    return FOLD_RE.sub("", value[0]).lstrip(" \t").rstrip("\r\n")
 
 class Message:
-    """A message handled by submit, composed of a body, some recipient
-    addresses and an envelope sender address."""
-
-    def __init__(self, config, body, rcpts, parse_rcpts = False, efrom = None):
-        """Create a new message to the given recipients containing the text
-        given in `body`.  If no envelope sender address is passed in `efrom`,
-        it is guessed from the message body.  If `parse_rcpts` is true, the
-        message body is parsed for additional recipients."""
+    """A message handled by submit, composed of a header, a body, some
+    recipient addresses and an envelope sender address.  Only the fields of
+    the header which submit needs are looked at (see `MessageHeader`); the
+    body is passed on untouched."""
+
+    body_crlf_size = None   # see `get_crlf_size`
+
+    def __init__(self, config, header, body, rcpts, parse_rcpts = False,
+            efrom = None):
+        """Create a new message to the given recipients consisting of the
+        `header` string and the `MessageBody` given in `body` (see
+        `spool_message`).  If no envelope sender address is passed in
+        `efrom`, it is guessed from the message header.  If `parse_rcpts` is
+        true, the message header is parsed for additional recipients."""
         self.rcpts = set()
         for rcpt in rcpts:
             name, addr = email.utils.parseaddr(rcpt)
             if addr:
                 self.rcpts.add(addr)
 
-        parser = email.parser.Parser()
-        self.message = parser.parsestr(self.received() + body, True)
+        self.message = MessageHeader(self.received() + header)
+        self.body = body
 
         if efrom is None:
             if not self.message.has_key("from"):
@@ -54,7 +159,7 @@ class Message:
 
     def received(self):
         """Return a Received: header."""
-        return "Received: by %s (submit); %s\n" % (socket.gethostname(),
+        return "Received: by %s (submit); %s\n" % (get_hostname(),
                 email.utils.formatdate())
 
     def guess_envelope_from(self):
@@ -67,7 +172,7 @@ class Message:
             return email.utils.parseaddr(self.message["from"])[1]
 
         username = pwd.getpwuid(os.getuid())[0]
-        mailname = default_mailname()
+        mailname = get_mailname()
         return "%s@%s" % (username, mailname)
 
     def add_recipient_addresses(self):
@@ -90,113 +195,77 @@ class Message:
     def get_delivery_methods(self, config):
         """Return (name, addresses) tuples of the config sections that apply
         for sending this message."""
-        methods = [method for method in config.get_methods()
-                if method not in ("local", "remote")]
-        methods.insert(0, "local")
-        methods.append("remote")
-
         dummy, fromaddr = email.utils.parseaddr(self.message["from"])
-        # (domain, method) mappings
-        dom_meth = []
-        for method in methods:
-            # skip the method if its “from” option is set and doesn’t match
-            # the From: header of this message
-            onlyfroms = config.get_method(str, method, "from")
-            if onlyfroms:
-                onlyfroms = onlyfroms.split(",")
-                for onlyfrom in onlyfroms:
-                    onlyfrom = onlyfrom.strip()
-                    if onlyfrom.startswith("@"):
-                        if fromaddr.endswith(onlyfrom):
-                            break
-                    else:
-                        if fromaddr == onlyfrom:
-                            break
-                else:
-                    continue
-
-            if method == "local":
-                domains = self.get_local_domains(config)
-            else:
-                domains = config.get_method(str, method, "domains")
-                if not domains: domains = [None]
-                else: domains = self.parse_domains(domains)
-
-            for domain in domains:
-                dom_meth.append((domain, method))
-
-        # (method, recipients) mappings
-        # initialize as {meth1: [], meth2: [], …}
-        meth_rcpt = dict([(method, []) for method in methods])
-        for rcpt in self.rcpts:
-            # no @ sign: local address
-            if rcpt.find("@") == -1:
-                meth_rcpt["local"].append(rcpt)
-                continue
-            # else, look for an appropriate mapping
-            for domain, method in dom_meth:
-                if domain is None or rcpt.endswith("@" + domain):
-                    meth_rcpt[method].append(rcpt)
-                    break
-            # if there is none, go with remote
-            else:
-                meth_rcpt["remote"].append(rcpt)
-
-        result = []
-        for method in methods:
-            if len(meth_rcpt[method]) > 0:
-                result.append((method, meth_rcpt[method]))
-        result.reverse()    # local delivery to the end, most likely to succeed
-
-        return result
+        return config.get_routing_table().route(fromaddr, self.rcpts)
 
     def create_deliverers(self, config):
         """Like `get_delivery_methods`, but return (deliverer, addresses)
-        tuples instead."""
-        result = []
-        for method, rcpts in self.get_delivery_methods(config):
-            result.append((config.create_deliverer(method), rcpts))
-        return result
-
-    def get_local_domains(self, config):
-        """Get the list of domains considered local (which usually is the
-        hostname and `localhost`)."""
-        result = set()
-        override = config.get_method(str, "local", "domains")
-        if override is None:
-            result.add(socket.gethostname())
-            result.add(socket.getfqdn())
-            result.add("localhost")
-
-        extra = config.get_method(str, "local", "extra_domains")
-        for conf in (override, extra):
-            if conf is None: continue
-            result |= self.parse_domains(conf)
-
-        return result
-
-    def parse_domains(self, domains):
-        """Return a set containing all domains from the comma-separated string
-        extracted from the configuration file."""
-        return set(map(str.strip, domains.split(",")))
+        tuples instead (see `Config.create_deliverers`)."""
+        return config.create_deliverers(self.get_delivery_methods(config))
+
+    def __getstate__(self):
+        """Pickle everything but the body, which is transferred as the
+        payload of the `Channel` frame instead."""
+        state = self.__dict__.copy()
+        del state["body"]
+        return state
+
+    def attach_payload(self, body):
+        """Set the body of a message received over a `Channel`."""
+        self.body = body
+
+    def get_header(self):
+        """Return the header of the message as a string, including the empty
+        line separating it from the body."""
+        return self.message.as_string()
+
+    def get_size(self):
+        """Return the size of the message in bytes."""
+        return len(self.get_header()) + self.body.size
+
+    def get_crlf_size(self):
+        """Return the size of the message in bytes once every line ends in
+        CRLF, which is how it is transmitted over SMTP.  The body is only
+        scanned the first time; its size is kept in `body_crlf_size`."""
+        if self.body_crlf_size is None:
+            self.body_crlf_size = crlf_size(self.body.chunks())
+        # the header ends with a line break, so it is counted on its own
+        return crlf_size([self.get_header()]) + self.body_crlf_size
+
+    def chunks(self):
+        """Iterate over the complete message (header and body) in strings of
+        limited size."""
+        yield self.get_header()
+        for chunk in self.body.chunks():
+            yield chunk
+
+    def lines(self):
+        """Iterate over the lines of the complete message."""
+        for line in self.get_header().splitlines(True):
+            yield line
+        for line in self.body.lines():
+            yield line
 
     def get_body(self):
-        """Return the body of the message as a string."""
-        return self.message.as_string(False)
-
-def default_mailname():
-    """Determine the default mailname by reading /etc/mailname or using the
-    hostname."""
-    fin = mailname = None
-    try:
-        fin = open("/etc/mailname")
-        mailname = fin.read().strip()
-    except IOError:
-        if fin: fin.close()
-
-    if not mailname:
-        return socket.getfqdn()
-    else:
-        return mailname
+        """Return the complete message as a string.  Prefer `chunks` or
+        `lines` for transmission, which avoid copying large bodies."""
+        return "".join(self.chunks())
+
+def crlf_size(chunks):
+    """Return the total size of the strings in `chunks` once every line
+    ends in CRLF."""
+    size = 0
+    last = ""
+    for chunk in chunks:
+        if not chunk: continue
+        # count the line breaks which lack their CR
+        size += len(chunk) + chunk.count("\n") - chunk.count("\r\n")
+        if last == "\r" and chunk[0] == "\n":
+            size -= 1
+        last = chunk[-1]
+    if last and last != "\n":
+        # the last line gets a line break as well
+        size += 2
+    return size
 
 # vim:tw=78:fo-=t:sw=4:sts=4:et:
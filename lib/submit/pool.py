@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of submit, a sendmail replacement or supplement for
+# multi-user desktop systems.
+#
+# Copyright © 2008 Michael Schutte <michi@uiae.at>
+#
+# submit is available under the terms of the MIT/X license.  Please see the
+# file COPYING for details.
+
+from __future__ import with_statement
+import threading
+import time
+
+__all__ = ["ConnectionPool"]
+
+DEFAULT_KEEPALIVE = 30      # seconds an idle connection is kept open
+
+class ConnectionPool:
+    """A pool of authenticated deliverers kept open between deliveries.  The
+    daemon process uses it to avoid a new connection, TLS handshake and SASL
+    authentication for each message sent to the same server.
+
+    Deliverers are pooled by the key returned from their `pool_key` method;
+    deliverers which return `None` there are never pooled."""
+
+    def __init__(self):
+        """Create an empty connection pool."""
+        self.idle = {}      # key: [(deliverer, deadline), …]
+        self.lock = threading.Lock()
+
+    def acquire(self, deliverer):
+        """Return an idle, authenticated deliverer equivalent to the given
+        (not yet authenticated) `deliverer`, or `None` if there is none.  The
+        session of the returned deliverer has already been reset."""
+        key = deliverer.pool_key()
+        if key is None: return None
+        while True:
+            with self.lock:
+                entries = self.idle.get(key)
+                if not entries: return None
+                pooled, deadline = entries.pop()
+            if time.time() < deadline and pooled.reset():
+                return pooled
+            pooled.abort()
+
+    def release(self, deliverer):
+        """Put `deliverer` back into the pool after a successful delivery.
+        If it cannot be pooled or pooling has been disabled for its delivery
+        method (`keepalive = 0`), close its connection instead."""
+        key = deliverer.pool_key()
+        keepalive = deliverer.config.get_method(int, deliverer.method,
+                "keepalive", DEFAULT_KEEPALIVE)
+        if key is None or keepalive <= 0:
+            deliverer.close()
+            return
+        with self.lock:
+            self.idle.setdefault(key, []).append(
+                    (deliverer, time.time() + keepalive))
+
+    def expire(self):
+        """Close idle connections which have timed out and check whether the
+        others are still alive.  Call this periodically."""
+        now = time.time()
+        with self.lock:
+            entries = [(key, entry) for key, entries in self.idle.items()
+                    for entry in entries]
+            self.idle.clear()
+        keep = []
+        for key, (deliverer, deadline) in entries:
+            if now < deadline and deliverer.ping():
+                keep.append((key, (deliverer, deadline)))
+            else:
+                deliverer.abort()
+        with self.lock:
+            for key, entry in keep:
+                self.idle.setdefault(key, []).append(entry)
+
+    def discard(self, method = None):
+        """Close all idle connections of the given delivery `method`, or all
+        idle connections if no method is given."""
+        with self.lock:
+            closing = []
+            for key, entries in self.idle.items():
+                for entry in entries[:]:
+                    if method is None or entry[0].method == method:
+                        entries.remove(entry)
+                        closing.append(entry[0])
+        for deliverer in closing:
+            deliverer.abort()
+
+# vim:tw=78:fo-=t:sw=4:sts=4:et:
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of submit, a sendmail replacement or supplement for
+# multi-user desktop systems.
+#
+# Copyright © 2008 Michael Schutte <michi@uiae.at>
+#
+# submit is available under the terms of the MIT/X license.  Please see the
+# file COPYING for details.
+
+from __future__ import with_statement
+from submit.errors import *
+from submit.i18n import *
+from select import select
+import errno
+import os
+import socket
+import threading
+import time
+
+__all__ = ["parse_relays", "open_connection", "relay_health"]
+
+ATTEMPT_DELAY = 0.25    # seconds before racing the next address (RFC 8305)
+RELAY_PENALTY = 300     # seconds a failed relay is tried last
+
+class RelayHealth:
+    """Remembers which relays have recently failed, so that they are tried
+    after the others.  There is one instance per process, so the knowledge
+    is kept for as long as the daemon process runs."""
+
+    def __init__(self):
+        """Create a new instance which knows of no failures."""
+        self.failures = {}  # (host, port): time of the last failure
+        self.lock = threading.Lock()
+
+    def order(self, relays):
+        """Sort the list of (host, port) `relays`: those which have failed
+        within the last `RELAY_PENALTY` seconds go last, the one that failed
+        longest ago first.  Otherwise, the order is kept."""
+        deadline = time.time() - RELAY_PENALTY
+        with self.lock:
+            failures = [self.failures.get(relay) for relay in relays]
+        keys = []
+        for index, failure in enumerate(failures):
+            if failure is None or failure < deadline:
+                keys.append((0, index))
+            else:
+                keys.append((1, failure))
+        return [relay for key, relay in sorted(zip(keys, relays))]
+
+    def failed(self, relay):
+        """Record a failure to connect to `relay`."""
+        with self.lock:
+            self.failures[relay] = time.time()
+
+    def succeeded(self, relay):
+        """Record a successful connection to `relay`."""
+        with self.lock:
+            self.failures.pop(relay, None)
+
+relay_health = RelayHealth()
+
+def parse_relays(hosts, default_port):
+    """Parse a comma-separated list of relays, each of which is a host name
+    or address, optionally followed by a colon and a port number (IPv6
+    addresses must then be put in brackets).  Return a list of (host, port)
+    tuples.  Raise a `ConfigError` if a relay cannot be parsed."""
+    relays = []
+    for relay in hosts.split(","):
+        relay = relay.strip()
+        if not relay: continue
+        host, port = relay, default_port
+        try:
+            if relay.startswith("["):
+                end = relay.index("]")
+                host = relay[1:end]
+                if relay[end + 1:end + 2] == ":":
+                    port = int(relay[end + 2:])
+                elif relay[end + 1:]:
+                    raise ValueError
+            elif relay.count(":") == 1:
+                host, port = relay.split(":")
+                port = int(port)
+        except ValueError:
+            raise ConfigError(n_('Invalid relay "%(relay)s": use HOST, '
+                'HOST:PORT or [ADDRESS]:PORT.'), relay=relay)
+        relays.append((host, port))
+    return relays
+
+def interleave(addresses):
+    """Reorder the result of `getaddrinfo` so that the address families
+    alternate, starting with the family of the first address."""
+    families = []
+    by_family = {}
+    for info in addresses:
+        if info[0] not in by_family:
+            families.append(info[0])
+            by_family[info[0]] = []
+        by_family[info[0]].append(info)
+    result = []
+    while by_family:
+        for family in families:
+            if family in by_family:
+                result.append(by_family[family].pop(0))
+                if not by_family[family]:
+                    del by_family[family]
+    return result
+
+def open_connection(host, port, timeout):
+    """Connect to `host` on TCP `port` and return the socket, which is set
+    to time out after `timeout` seconds.  All addresses of the host are
+    tried, alternating between IPv6 and IPv4: if an attempt has not
+    succeeded after `ATTEMPT_DELAY` seconds, the next one is started in
+    parallel, and the first connection established wins (“happy eyeballs”,
+    RFC 8305).  If no connection can be made within `timeout` seconds,
+    `socket.error` is raised."""
+    addresses = interleave(socket.getaddrinfo(host, port, 0,
+        socket.SOCK_STREAM))
+    deadline = time.time() + timeout
+    pending = []
+    error = None
+    next_attempt = 0
+    try:
+        while True:
+            now = time.time()
+            if now >= deadline:
+                raise socket.timeout, "timed out"
+            if addresses and now >= next_attempt:
+                family, tpe, proto, name, address = addresses.pop(0)
+                sock = socket.socket(family, tpe, proto)
+                sock.setblocking(0)
+                result = sock.connect_ex(address)
+                if result in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    pending.append(sock)
+                else:
+                    sock.close()
+                    error = socket.error(result, os.strerror(result))
+                    continue
+                next_attempt = now + ATTEMPT_DELAY
+            if not pending:
+                if addresses:
+                    continue
+                if error is None:
+                    error = socket.error("no address for %s" % host)
+                raise error
+            wait = deadline
+            if addresses: wait = min(wait, next_attempt)
+            rlist, wlist, xlist = select([], pending, [],
+                    max(wait - now, 0))
+            for sock in wlist:
+                pending.remove(sock)
+                result = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if result == 0:
+                    sock.settimeout(timeout)
+                    return sock
+                sock.close()
+                error = socket.error(result, os.strerror(result))
+                # try the next address right away
+                next_attempt = 0
+    finally:
+        for sock in pending:
+            sock.close()
+
+# vim:tw=78:fo-=t:sw=4:sts=4:et:
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of submit, a sendmail replacement or supplement for
+# multi-user desktop systems.
+#
+# Copyright © 2008 Michael Schutte <michi@uiae.at>
+#
+# submit is available under the terms of the MIT/X license.  Please see the
+# file COPYING for details.
+
+from submit.hostinfo import *
+
+__all__ = ["RoutingTable"]
+
+class RoutingTable:
+    """The delivery method sections of a configuration, compiled into a form
+    which allows to find the method responsible for a recipient with a
+    single dictionary lookup.  Use `Config.get_routing_table` to obtain the
+    (cached) table of a configuration."""
+
+    def __init__(self, config):
+        """Compile the routing table of `config`.  `local` always comes
+        first, `remote` always comes last."""
+        self.methods = [method for method in config.get_methods()
+                if method not in ("local", "remote")]
+        self.methods.insert(0, "local")
+        self.methods.append("remote")
+
+        self.filters = []   # per method: None or (addresses, domains)
+        self.domains = {}   # domain: [method index, …] (ascending)
+        self.catchall = []  # indices of methods without a domain list
+        for index, method in enumerate(self.methods):
+            self.filters.append(self.compile_from(
+                config.get_method(str, method, "from")))
+            if method == "local":
+                domains = self.get_local_domains(config)
+            else:
+                domains = config.get_method(str, method, "domains")
+                if not domains:
+                    self.catchall.append(index)
+                    continue
+                domains = self.parse_domains(domains)
+            for domain in domains:
+                self.domains.setdefault(domain, []).append(index)
+
+    def compile_from(self, onlyfroms):
+        """Compile the value of a `from` option into a tuple of a set of
+        addresses and a tuple of domain suffixes (starting with an at
+        sign).  Return `None` if the option is not set."""
+        if not onlyfroms: return None
+        addresses = set()
+        suffixes = []
+        for onlyfrom in onlyfroms.split(","):
+            onlyfrom = onlyfrom.strip()
+            if onlyfrom.startswith("@"):
+                suffixes.append(onlyfrom)
+            else:
+                addresses.add(onlyfrom)
+        return (frozenset(addresses), tuple(suffixes))
+
+    def get_local_domains(self, config):
+        """Get the list of domains considered local (which usually is the
+        hostname and `localhost`)."""
+        result = set()
+        override = config.get_method(str, "local", "domains")
+        if override is None:
+            result.add(get_hostname())
+            result.add(get_fqdn())
+            result.add("localhost")
+
+        extra = config.get_method(str, "local", "extra_domains")
+        for conf in (override, extra):
+            if conf is None: continue
+            result |= self.parse_domains(conf)
+
+        return result
+
+    def parse_domains(self, domains):
+        """Return a set containing all domains from the comma-separated string
+        extracted from the configuration file."""
+        return set(map(str.strip, domains.split(",")))
+
+    def get_active(self, fromaddr):
+        """Return a list telling for each method whether its `from` option
+        (if any) matches the sender address `fromaddr`."""
+        active = []
+        for onlyfrom in self.filters:
+            if onlyfrom is None:
+                active.append(True)
+            else:
+                addresses, suffixes = onlyfrom
+                active.append(fromaddr in addresses or
+                        fromaddr.endswith(suffixes))
+        return active
+
+    def route(self, fromaddr, rcpts):
+        """Return (name, addresses) tuples of the methods which apply for
+        sending a message from `fromaddr` to `rcpts`.  The method handling
+        local delivery comes last."""
+        active = self.get_active(fromaddr)
+        catchall = None
+        for index in self.catchall:
+            if active[index]:
+                catchall = index
+                break
+        local = 0
+        remote = len(self.methods) - 1
+
+        routes = [[] for method in self.methods]
+        for rcpt in rcpts:
+            at = rcpt.rfind("@")
+            # no @ sign: local address
+            if at == -1:
+                routes[local].append(rcpt)
+                continue
+            # else, the first matching method wins; if there is none, go
+            # with remote
+            index = catchall
+            for candidate in self.domains.get(rcpt[at + 1:], ()):
+                if active[candidate]:
+                    if index is None or candidate < index:
+                        index = candidate
+                    break
+            if index is None:
+                index = remote
+            routes[index].append(rcpt)
+
+        result = []
+        for method, addresses in zip(self.methods, routes):
+            if len(addresses) > 0:
+                result.append((method, addresses))
+        result.reverse()    # local delivery to the end, most likely to succeed
+        return result
+
+# vim:tw=78:fo-=t:sw=4:sts=4:et:
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of submit, a sendmail replacement or supplement for
+# multi-user desktop systems.
+#
+# Copyright © 2008 Michael Schutte <michi@uiae.at>
+#
+# submit is available under the terms of the MIT/X license.  Please see the
+# file COPYING for details.
+
+from __future__ import with_statement
+from submit.body import *
+import cPickle as pickle
+import errno
+import itertools
+import os
+import threading
+import time
+
+__all__ = ["Spool", "SpoolEntry"]
+
+DEFAULT_RETRY_DELAY = 60        # seconds before the first retry
+DEFAULT_MAX_RETRY_DELAY = 3600  # the delay doubles up to this many seconds
+DEFAULT_LIFETIME = 120          # hours until a message is given up
+
+class SpoolEntry:
+    """A message in the spool, together with the delivery methods it still
+    has to be delivered through."""
+
+    def __init__(self, name, confdir, message, routes):
+        """Create a new entry called `name` for `message`, which is to be
+        delivered according to the configuration in `confdir`.  `routes` is
+        a list of (method, recipients) tuples."""
+        self.name = name
+        self.confdir = confdir
+        self.message = message
+        self.routes = routes
+        self.failed = []        # (method, recipients, error message) tuples
+        self.error = None       # the last temporary error
+        self.created = time.time()
+        self.attempts = 0
+        self.next_try = self.created
+        self.busy = True        # a delivery attempt is in progress
+
+    def __getstate__(self):
+        """Pickle the entry without the in-memory state."""
+        state = self.__dict__.copy()
+        del state["busy"]
+        return state
+
+    def __setstate__(self, state):
+        """Restore a pickled entry."""
+        self.__dict__.update(state)
+        self.busy = False
+
+    def expired(self, config):
+        """Determine whether the message has been in the spool for longer
+        than `general.spool_lifetime` hours."""
+        lifetime = config.get_general(int, "spool_lifetime", DEFAULT_LIFETIME)
+        return time.time() > self.created + 3600 * lifetime
+
+    def defer(self, config):
+        """Schedule the next delivery attempt.  The delay starts at
+        `general.retry_delay` seconds and doubles with every attempt up to
+        `general.max_retry_delay` seconds."""
+        delay = config.get_general(int, "retry_delay", DEFAULT_RETRY_DELAY)
+        max_delay = config.get_general(int, "max_retry_delay",
+                DEFAULT_MAX_RETRY_DELAY)
+        self.attempts += 1
+        delay = min(delay * 2 ** min(self.attempts - 1, 30), max_delay)
+        self.next_try = time.time() + max(delay, 1)
+
+class Spool:
+    """A directory where the daemon process keeps the messages it has
+    accepted until they are delivered.  Each message is stored in two
+    files, its body and the pickled `SpoolEntry`.  Both are written to the
+    `tmp` subdirectory, synced to disk and then renamed into `queue`, so a
+    crash never leaves a half-written message behind.  Messages which cannot
+    be delivered are moved to `failed`."""
+
+    def __init__(self, path):
+        """Open the spool in the directory `path`, creating it if necessary,
+        and load the messages left over by an earlier daemon process."""
+        self.path = path
+        self.entries = {}   # name: SpoolEntry
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        for subdir in ("tmp", "queue", "failed"):
+            subdir = os.path.join(path, subdir)
+            if not os.path.isdir(subdir):
+                os.makedirs(subdir, 0700)
+        self.recover()
+
+    def filename(self, subdir, name, suffix):
+        """Return the path to the file `name` + `suffix` in `subdir`."""
+        return os.path.join(self.path, subdir, name + suffix)
+
+    def recover(self):
+        """Load the entries found in `queue`.  Incomplete messages are
+        removed; entries without a body are moved to `failed`."""
+        for filename in os.listdir(os.path.join(self.path, "tmp")):
+            os.remove(os.path.join(self.path, "tmp", filename))
+        queue = os.listdir(os.path.join(self.path, "queue"))
+        for filename in queue:
+            name, suffix = os.path.splitext(filename)
+            if suffix == ".body" and name + ".entry" not in queue:
+                os.remove(self.filename("queue", name, ".body"))
+            elif suffix != ".entry":
+                continue
+            elif name + ".body" not in queue:
+                os.rename(self.filename("queue", name, ".entry"),
+                        self.filename("failed", name, ".entry"))
+            else:
+                with open(self.filename("queue", name, ".entry"), "rb") as fin:
+                    entry = pickle.load(fin)
+                self.entries[entry.name] = entry
+
+    def write(self, name, suffix, chunks):
+        """Write the strings from `chunks` to the file `name` + `suffix` in
+        `queue`, replacing it atomically."""
+        tmpname = self.filename("tmp", name, suffix)
+        fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, "wb") as fout:
+            for chunk in chunks:
+                fout.write(chunk)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.rename(tmpname, self.filename("queue", name, suffix))
+
+    def sync(self):
+        """Make sure that renames in `queue` have reached the disk."""
+        fd = os.open(os.path.join(self.path, "queue"), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def put(self, confdir, message, routes):
+        """Store `message` (see `SpoolEntry`) and return its new entry.  The
+        entry is marked busy, as the caller is expected to try delivering it
+        right away."""
+        with self.lock:
+            name = "%d.%d_%d" % (time.time(), os.getpid(), self.counter.next())
+        entry = SpoolEntry(name, confdir, message, routes)
+        self.write(name, ".body", message.body.chunks())
+        self.write(name, ".entry", [pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)])
+        self.sync()
+        with self.lock:
+            self.entries[name] = entry
+        return entry
+
+    def load(self, entry):
+        """Return the message of `entry` with its body read from the
+        spool."""
+        body = open(self.filename("queue", entry.name, ".body"), "rb")
+        entry.message.attach_payload(MessageBody(fileobj=body))
+        return entry.message
+
+    def due(self):
+        """Return the entries whose next delivery attempt is due and mark
+        them busy."""
+        now = time.time()
+        with self.lock:
+            due = [entry for entry in self.entries.itervalues()
+                    if not entry.busy and entry.next_try <= now]
+            for entry in due:
+                entry.busy = True
+        due.sort(key=lambda entry: entry.next_try)
+        return due
+
+    def update(self, entry, routes, error, config):
+        """Record the outcome of a delivery attempt: `routes` are the
+        (method, recipients) tuples which still have to be tried again;
+        `error` describes why.  Depending on what is left, the entry is
+        removed, moved to `failed` or scheduled for another attempt; either
+        way, it is no longer busy."""
+        entry.routes = routes
+        entry.error = error
+        if routes and entry.expired(config):
+            entry.failed.extend([(method, rcpts, error)
+                for method, rcpts in routes])
+            entry.routes = routes = []
+        if routes:
+            entry.defer(config)
+            self.write(entry.name, ".entry",
+                    [pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)])
+            # the body is read from the spool again on the next attempt
+            entry.message.attach_payload(None)
+        elif entry.failed:
+            self.write(entry.name, ".entry",
+                    [pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)])
+            self.fail(entry)
+        else:
+            self.remove(entry)
+        entry.busy = False
+
+    def remove(self, entry):
+        """Delete the message of `entry` from the spool."""
+        with self.lock:
+            self.entries.pop(entry.name, None)
+        os.remove(self.filename("queue", entry.name, ".entry"))
+        os.remove(self.filename("queue", entry.name, ".body"))
+
+    def fail(self, entry):
+        """Give up on the message of `entry` and move it to `failed`, where
+        the reasons are written to a readable `.error` file."""
+        with self.lock:
+            self.entries.pop(entry.name, None)
+        with open(self.filename("failed", entry.name, ".error"), "w") as fout:
+            for method, rcpts, error in entry.failed:
+                fout.write("%s (%s): %s\n" % (method, ", ".join(rcpts), error))
+        for suffix in (".body", ".entry"):
+            try:
+                os.rename(self.filename("queue", entry.name, suffix),
+                        self.filename("failed", entry.name, suffix))
+            except OSError, e:
+                # the body may be what has gone missing
+                if e.errno != errno.ENOENT: raise
+        self.sync()
+
+# vim:tw=78:fo-=t:sw=4:sts=4:et:
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of submit, a sendmail replacement or supplement for
+# multi-user desktop systems.
+#
+# Copyright © 2008 Michael Schutte <michi@uiae.at>
+#
+# submit is available under the terms of the MIT/X license.  Please see the
+# file COPYING for details.
+
+from __future__ import with_statement
+import os
+import threading
+import time
+
+__all__ = ["monotonic", "record", "timed", "Stopwatch", "stats",
+        "StatsRequest", "StatsReport"]
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+        5, 10, 30, 60, 300)
+
+CLOCK_MONOTONIC = 1     # from <time.h> on Linux
+
+clock = None
+
+def monotonic():
+    """Return the value of a clock which never goes backwards, in seconds.
+    Python 2 has none, so `clock_gettime` is called through `ctypes`; if
+    that does not work, this falls back to `time.time`.  The clock is looked
+    up on first use, as loading `ctypes` takes a while."""
+    global clock
+    if clock is None:
+        clock = load_clock()
+    return clock()
+
+def load_clock():
+    """Return a function reading the monotonic clock."""
+    try:
+        import ctypes
+        class timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+        try:
+            clock_gettime = ctypes.CDLL(None).clock_gettime
+        except AttributeError:
+            # older C libraries keep it in librt
+            clock_gettime = ctypes.CDLL("librt.so.1").clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        ts = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            return time.time
+    except (ImportError, OSError, AttributeError):
+        return time.time
+
+    def read():
+        clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    lock = threading.Lock()
+
+    def locked_read():
+        # `ts` is shared between threads
+        with lock:
+            return read()
+    return locked_read
+
+class Histogram:
+    """The distribution of the durations of a stage, in the buckets given
+    by `BUCKETS`."""
+
+    def __init__(self):
+        """Create an empty histogram."""
+        self.buckets = [0] * (len(BUCKETS) + 1)     # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        """Record a duration."""
+        index = 0
+        while index < len(BUCKETS) and seconds > BUCKETS[index]:
+            index += 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, fraction):
+        """Estimate the given `fraction` quantile as the upper bound of the
+        bucket it falls into (the largest duration for the last one)."""
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def copy(self):
+        """Return a copy of this histogram."""
+        other = Histogram()
+        other.__dict__.update(self.__dict__)
+        other.buckets = self.buckets[:]
+        return other
+
+class Stats:
+    """The durations of the stages of message submission, collected in
+    histograms by the daemon process.  Until `enable` is called, nothing is
+    measured, so that the frontend does not pay for the clock."""
+
+    def __init__(self):
+        """Create an empty collection."""
+        self.enabled = False
+        self.histograms = {}    # stage: Histogram
+        self.lock = threading.Lock()
+
+    def enable(self):
+        """Start measuring."""
+        self.enabled = True
+
+    def record(self, stage, seconds):
+        """Add a duration of `seconds` to the histogram of `stage`."""
+        if not self.enabled: return
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.add(max(seconds, 0.0))
+
+    def snapshot(self):
+        """Return a copy of all histograms as a dictionary."""
+        with self.lock:
+            return dict([(stage, histogram.copy())
+                for stage, histogram in self.histograms.iteritems()])
+
+    def write_prometheus(self, filename):
+        """Write the histograms to `filename` in the text format read by the
+        node exporter of Prometheus.  The file is replaced atomically."""
+        lines = ["# HELP submit_stage_seconds Time spent in each stage of "
+                "message submission.", "# TYPE submit_stage_seconds histogram"]
+        for stage, histogram in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), histogram.buckets):
+                cumulative += count
+                lines.append('submit_stage_seconds_bucket{stage="%s",'
+                        'le="%s"} %d' % (stage, bound, cumulative))
+            lines.append('submit_stage_seconds_sum{stage="%s"} %f'
+                    % (stage, histogram.sum))
+            lines.append('submit_stage_seconds_count{stage="%s"} %d'
+                    % (stage, histogram.count))
+        tmpname = "%s.%d.tmp" % (filename, os.getpid())
+        with open(tmpname, "w") as fout:
+            fout.write("\n".join(lines) + "\n")
+        os.rename(tmpname, filename)
+
+stats = Stats()
+
+def record(stage, seconds, into = None):
+    """Add a duration of `seconds` to the histogram of `stage` and, if
+    `into` is given, to the entry for `stage` in that dictionary."""
+    if not stats.enabled: return
+    stats.record(stage, seconds)
+    if into is not None:
+        into[stage] = into.get(stage, 0) + seconds
+
+class Timer:
+    """A context manager measuring the time spent in a stage (see
+    `timed`)."""
+
+    def __init__(self, stage, into = None):
+        """Measure the time of `stage`."""
+        self.stage = stage
+        self.into = into
+        self.start = None
+
+    def __enter__(self):
+        """Start the clock."""
+        if stats.enabled:
+            self.start = monotonic()
+
+    def __exit__(self, *exc_info):
+        """Record the time since `__enter__`, even if an exception has
+        occurred."""
+        if self.start is not None:
+            record(self.stage, monotonic() - self.start, self.into)
+
+def timed(stage, into = None):
+    """Return a context manager which adds the time spent in it to the
+    histogram of `stage` and, if `into` is given, to the entry for `stage`
+    in that dictionary."""
+    return Timer(stage, into)
+
+class Stopwatch:
+    """A context manager adding up the time spent in it, over any number of
+    `with` blocks, in `elapsed`, so that it can be passed to `record` as a
+    single measurement."""
+
+    def __init__(self):
+        """Create a stopwatch showing zero."""
+        self.elapsed = 0.0
+        self.start = None
+
+    def __enter__(self):
+        """Start the clock."""
+        if stats.enabled:
+            self.start = monotonic()
+
+    def __exit__(self, *exc_info):
+        """Stop the clock."""
+        if self.start is not None:
+            self.elapsed += monotonic() - self.start
+            self.start = None
+
+class StatsRequest:
+    """Answer to a `ConfigRequest`: ask the daemon for its statistics
+    instead of submitting a message."""
+
+class StatsReport:
+    """The answer to a `StatsRequest`: the histograms of the daemon as a
+    dictionary keyed by stage."""
+
+    def __init__(self, histograms):
+        """Report the given `histograms`."""
+        self.histograms = histograms
+
+# vim:tw=78:fo-=t:sw=4:sts=4:et: